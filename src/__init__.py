@@ -29,8 +29,18 @@ def quickstart(*args, **kwargs):
   """__population_doc__"""
   return Population(*args, **kwargs)
 
+def serve(population, port=8888, **kwargs):
+  """Serve BQL queries on a Population over local HTTP, batching requests.
+
+  See bdbcontrib.server.serve for the options, and bdbcontrib.server for
+  the protocol.
+  """
+  from bdbcontrib import server
+  return server.serve(population, port=port, **kwargs)
+
 __all__ = [
     'quickstart',
+    'serve',
     'Population',
     '__version__',
 ]
@@ -14,7 +14,19 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import contextlib
+import csv
+import itertools
+import json
+import multiprocessing
+import numbers
+import numpy as np
+import os
 import pandas as pd
+import random
+import re
+import struct
+import time
 
 import bayeslite.core
 from bayeslite import bayesdb_open
@@ -24,6 +36,11 @@ from bayeslite.loggers import logged_query
 from bayeslite.read_pandas import bayesdb_read_pandas_df
 from bayeslite.sqlite3_util import sqlite3_quote_name
 from bayeslite.util import cursor_value
+from bdbcontrib import cost_model
+from bdbcontrib.diagnostic_utils import crosscat_diagnostics_history
+from bdbcontrib.diagnostic_utils import gelman_rubin
+from bdbcontrib.diagnostic_utils import logscore_plateaued
+from bdbcontrib.fingerprint import table_fingerprint
 from bdbcontrib.population_method import population_method
 
 from bdbcontrib.population_method import population_method
@@ -148,8 +165,10 @@ def df_to_table(df, tablename=None, **kwargs):
     bayesdb_read_pandas_df(bdb, tablename, df, create=True)
     return (bdb, tablename)
 
-@population_method(population_to_bdb=0, interpret_bql=1, logger="logger")
-def query(bdb, bql, bindings=None, logger=None):
+@population_method(population_to_bdb=0, interpret_bql=1, logger="logger",
+                   generator_name='generator_name')
+def query(bdb, bql, bindings=None, logger=None, models=None, seed=None,
+          generator_name=None):
     """Execute the `bql` query on the `bdb` instance.
 
     Parameters
@@ -157,6 +176,17 @@ def query(bdb, bql, bindings=None, logger=None):
     bdb : __population_to_bdb__
     bql : __interpret_bql__
     bindings : Values to safely fill in for '?' in the BQL query.
+    models : int or list of int, optional
+        If a number, answer using only that many models of the generator,
+        chosen at random, for a quicker, approximate answer. If a list,
+        using only the models it numbers.
+    seed : int, optional
+        With a number of models, the entropy for choosing them.
+    generator_name : __generator_name__
+
+    Pairwise queries that cost_model.explain_cost predicts to be expensive,
+    for the generator they name, draw a warning, or, for pairwise row similarity in a
+    bdb file, run in parallel processes instead.
 
     Returns
     -------
@@ -167,8 +197,315 @@ def query(bdb, bql, bindings=None, logger=None):
         bindings = ()
     if logger:
         logger.info("BQL [%s] %s", bql, bindings)
-    cursor = bdb.execute(bql, bindings)
-    return cursor_to_df(cursor)
+    if models is None:
+        if cost_model.is_pairwise(bql):
+            routed = route_expensive_query(bdb, bql, bindings, logger)
+            if routed is not None:
+                return routed
+        cursor = bdb.execute(bql, bindings)
+        return cursor_to_df(cursor)
+    if generator_name is None:
+        raise BLE(ValueError('Need a generator_name to restrict models of.'))
+    if isinstance(models, numbers.Integral):
+        generator_id = bayeslite.core.bayesdb_get_generator(bdb, generator_name)
+        modelnos = bayeslite.core.bayesdb_generator_modelnos(bdb, generator_id)
+        models = random.Random(seed).sample(modelnos, min(int(models),
+                                                          len(modelnos)))
+    with restrict_models(bdb, generator_name, models):
+        cursor = bdb.execute(bql, bindings)
+        return cursor_to_df(cursor)
+
+@population_method(population_to_bdb=0, interpret_bql=1, logger="logger")
+def query_to_file(bdb, bql, path, bindings=None, format='csv',
+                  chunk_rows=10000, logger=None):
+    """Stream the results of the `bql` query into a file, chunk by chunk.
+
+    Memory use is bounded by `chunk_rows`, not by the size of the result
+    (though bayeslite itself may hold some queries' results in memory).
+
+    Parameters
+    ----------
+    bdb : __population_to_bdb__
+    bql : __interpret_bql__
+    path : str
+        Where to write the results.
+    bindings : Values to safely fill in for '?' in the BQL query.
+    format : str
+        'csv' for a comma-separated file with a header row, 'npy' for a
+        two-dimensional numpy array of floats (None becomes NaN), or
+        'columnar' for a directory holding a numpy array for each numeric
+        column, a file of JSON lines for each other column, and a
+        columns.json describing them. In the columnar format, the first
+        chunk decides which columns are numeric.
+    chunk_rows : int
+        How many rows to write at a time.
+
+    Returns
+    -------
+    report : dict
+        The 'path', and the number of 'rows' written, in how many
+        'seconds', at how many 'rows_per_second'.
+    """
+    if format not in QUERY_FILE_WRITERS:
+        raise BLE(ValueError('Unknown format %r; try one of %s.' %
+                             (format, ', '.join(sorted(QUERY_FILE_WRITERS)))))
+    if bindings is None:
+        bindings = ()
+    start = time.time()
+    rows = 0
+    # As in cursor_to_df, a savepoint enables caching from row to row.
+    with bdb.savepoint():
+        cursor = bdb.execute(bql, bindings)
+        columns = [desc[0] for desc in cursor.description or []]
+        writer = QUERY_FILE_WRITERS[format](path, columns)
+        try:
+            while True:
+                chunk = list(itertools.islice(cursor, chunk_rows))
+                if not chunk:
+                    break
+                writer.write(chunk)
+                rows += len(chunk)
+        finally:
+            writer.close()
+    seconds = time.time() - start
+    rate = rows / seconds if seconds > 0 else float('inf')
+    if logger:
+        logger.info("Wrote %d rows to %s in %.1f seconds (%.0f rows/s).",
+                    rows, path, seconds, rate)
+    return {'path': path, 'rows': rows, 'seconds': seconds,
+            'rows_per_second': rate}
+
+class CsvRowWriter(object):
+    """Writes rows to a csv file, after a header row."""
+
+    def __init__(self, path, columns):
+        self.file = open(path, 'wb')
+        self.csv = csv.writer(self.file)
+        self.csv.writerow([self.encode(column) for column in columns])
+
+    @staticmethod
+    def encode(value):
+        return value.encode('utf-8') if isinstance(value, unicode) else value
+
+    def write(self, rows):
+        self.csv.writerows([[self.encode(v) for v in row] for row in rows])
+
+    def close(self):
+        self.file.close()
+
+# Bytes reserved for the header of streamed .npy files, so that it can be
+# rewritten with the final shape once the rows are counted.
+NPY_HEADER_BYTES = 128
+
+class NpyRowWriter(object):
+    """Writes rows of numbers to a .npy file of float64s, as they come.
+
+    With `columns` None, writes single values into a one-dimensional array.
+    """
+
+    def __init__(self, path, columns):
+        self.file = open(path, 'wb')
+        self.columns = columns
+        self.rows = 0
+        self.file.write(self.header())
+
+    def header(self):
+        if self.columns is None:
+            shape = (self.rows,)
+        else:
+            shape = (self.rows, len(self.columns))
+        header = ("{'descr': '<f8', 'fortran_order': False, 'shape': %r, }"
+                  % (shape,))
+        # Magic string, version and header length take the first 10 bytes.
+        header = header.ljust(NPY_HEADER_BYTES - 10 - 1) + '\n'
+        return '\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header
+
+    def write(self, rows):
+        try:
+            array = np.array(rows, dtype=float)
+        except (TypeError, ValueError):
+            raise BLE(ValueError('Cannot write non-numeric results as npy; '
+                                 'try csv or columnar.'))
+        array.astype('<f8').tofile(self.file)
+        self.rows += len(rows)
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(self.header())
+        self.file.close()
+
+class ColumnarRowWriter(object):
+    """Writes each column of rows to its own file in a directory."""
+
+    def __init__(self, path, columns):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.columns = columns
+        self.writers = None
+        self.numeric = None
+        self.rows = 0
+
+    def open_columns(self, rows):
+        self.numeric = [all(isinstance(row[i], (int, long, float)) or
+                            row[i] is None for row in rows)
+                        for i in range(len(self.columns))]
+        self.writers = []
+        for i, numeric in enumerate(self.numeric):
+            filename = os.path.join(self.path, '%d.%s' % (
+                i, 'npy' if numeric else 'jsonl'))
+            self.writers.append(NpyRowWriter(filename, None) if numeric
+                                else open(filename, 'wb'))
+
+    def write(self, rows):
+        if self.writers is None:
+            self.open_columns(rows)
+        for i, writer in enumerate(self.writers):
+            values = [row[i] for row in rows]
+            if self.numeric[i]:
+                writer.write([np.nan if v is None else v for v in values])
+            else:
+                writer.write(''.join(json.dumps(v) + '\n' for v in values))
+        self.rows += len(rows)
+
+    def close(self):
+        if self.writers is None:
+            self.open_columns([])
+        for writer in self.writers:
+            writer.close()
+        with open(os.path.join(self.path, 'columns.json'), 'wb') as f:
+            json.dump({'rows': self.rows, 'columns': [
+                {'name': name,
+                 'file': '%d.%s' % (i, 'npy' if numeric else 'jsonl')}
+                for i, (name, numeric)
+                in enumerate(zip(self.columns, self.numeric))]}, f)
+
+QUERY_FILE_WRITERS = {
+    'csv': CsvRowWriter,
+    'npy': NpyRowWriter,
+    'columnar': ColumnarRowWriter,
+}
+
+PAIRWISE_SIMILARITY = re.compile(
+    r'^\s*ESTIMATE\s+SIMILARITY\s+FROM\s+PAIRWISE\s+("?)(\w+)\1\s*;?\s*$',
+    re.I)
+
+def route_expensive_query(bdb, bql, bindings, logger):
+    """Run an expensive pairwise query in parallel and return its answer, or
+    return None to run it as usual, warning if it is expensive.
+
+    Costs the query against the generator it names. Queries naming no
+    existing generator, or which cannot be costed, run as usual."""
+    generator_name = cost_model.pairwise_generator(bql)
+    if generator_name is None or \
+            not bayeslite.core.bayesdb_has_generator(bdb, generator_name):
+        return None
+    try:
+        cost = cost_model.explain_cost(bdb, bql, generator_name=generator_name)
+    except Exception:  # pylint: disable=broad-except
+        # The estimate is advisory: never let it stand in the query's way.
+        if logger:
+            logger.debug("Could not predict the cost of %s.", bql)
+        return None
+    if not cost['expensive']:
+        return None
+    similarity = PAIRWISE_SIMILARITY.match(bql)
+    # The workers open the file themselves with only the builtin metamodels,
+    # so only crosscat generators can go to them.
+    if (similarity is not None and not bindings and
+            bdb.pathname not in (None, ':memory:') and
+            bayeslite.core.bayesdb_generator_metamodel(bdb,
+                bayeslite.core.bayesdb_get_generator(bdb, generator_name))
+            == 'crosscat'):
+        if logger:
+            logger.info("Predicted %.0f seconds for %s; running it in "
+                        "parallel.", cost['seconds'], bql)
+        from bdbcontrib import parallel
+        return parallel.query_pairwise_similarity(bdb, generator_name)
+    if logger:
+        logger.warn("This query may take about %.0f seconds: %d rows, "
+                    "%d columns, %d models of %.1f views on average.",
+                    cost['seconds'], cost['rows'], cost['columns'],
+                    cost['models'], cost['views'])
+    return None
+
+@population_method(population_to_bdb=0, interpret_bql=1,
+                   generator_name='generator_name')
+def query_progressively(bdb, bql, bindings=None, batch=10, seed=None,
+                        generator_name=None):
+    """Estimate `bql` on a growing random subset of the models.
+
+    Runs the query on successive disjoint random batches of the generator's
+    models, and after each batch yields the mean of the answers so far,
+    weighted by batch size, with standard errors from the spread of the
+    batches' answers.  Stop iterating once the answer is good enough.
+
+    Rows of the answers are matched by position, so the query must return
+    the same rows in the same order for any set of models: order by
+    columns of the data, not by estimates.
+
+    Parameters
+    ----------
+    bdb : __population_to_bdb__
+    bql : __interpret_bql__
+    bindings : Values to safely fill in for '?' in the BQL query.
+    batch : int
+        How many models to add to the estimate at each step.
+    seed : int, optional
+        The entropy for ordering the models.
+    generator_name : __generator_name__
+
+    Yields
+    ------
+    (models, estimate, standard_error) : (int, DataFrame, DataFrame)
+        The number of models so far, and the query's answer and its
+        standard error in its numeric columns (NaN after one batch).
+    """
+    generator_id = bayeslite.core.bayesdb_get_generator(bdb, generator_name)
+    modelnos = list(bayeslite.core.bayesdb_generator_modelnos(bdb,
+                                                              generator_id))
+    random.Random(seed).shuffle(modelnos)
+    answers = []
+    sizes = []
+    for start in xrange(0, len(modelnos), batch):
+        subset = modelnos[start:start + batch]
+        answer = query(bdb, bql, bindings, models=subset,
+                       generator_name=generator_name)
+        if answers and answer.shape != answers[0].shape:
+            raise BLE(ValueError('Query answers differ in shape from model '
+                                 'to model; cannot combine them.'))
+        answers.append(answer)
+        sizes.append(len(subset))
+        numeric = [col for col in answer.columns
+                   if answer[col].dtype.kind in 'biuf']
+        values = np.array([a[numeric].values for a in answers], dtype=float)
+        weights = np.array(sizes, dtype=float) / sum(sizes)
+        estimate = answers[0].copy()
+        estimate[numeric] = np.tensordot(weights, values, axes=1)
+        standard_error = estimate.copy()
+        if len(answers) > 1:
+            standard_error[numeric] = (np.std(values, axis=0, ddof=1) /
+                                       np.sqrt(len(answers)))
+        else:
+            standard_error[numeric] = np.nan
+        yield (sum(sizes), estimate, standard_error)
+
+@contextlib.contextmanager
+def restrict_models(bdb, generator_name, modelnos):
+    """Within the block, the generator has only the models `modelnos`.
+
+    The others are dropped in a savepoint that is rolled back afterwards,
+    so no model is lost -- and nothing else done within the block lasts.
+    """
+    generator_id = bayeslite.core.bayesdb_get_generator(bdb, generator_name)
+    unwanted = (set(bayeslite.core.bayesdb_generator_modelnos(bdb,
+                                                              generator_id))
+                - set(modelnos))
+    with bdb.savepoint_rollback():
+        if unwanted:
+            bdb.execute('DROP MODELS %s FROM %s' %
+                        (modelset_bql(unwanted), quote(generator_name)))
+        yield
 
 @population_method(population_to_bdb=0, population_name=1)
 def describe_table(bdb, table_name):
@@ -323,7 +660,9 @@ def get_column_stattype(bdb, generator_name, column_name):
 
 @population_method(population=0, generator_name='generator_name')
 def analyze(self, models=100, minutes=0, iterations=0, checkpoint=0,
-            generator_name=None):
+            generator_name=None, until=None, window=5, tolerance=0.01,
+            processes=None, seed=0, resume=False, background=False,
+            generators=None):
   '''Run analysis.
 
   models : integer
@@ -334,33 +673,113 @@ def analyze(self, models=100, minutes=0, iterations=0, checkpoint=0,
       How long you want to let it run.
   iterations : integer
       How many iterations to let it run.
+  until : 'converged' or None
+      If 'converged', analyze in increments of `checkpoint` iterations and
+      stop analyzing each model once its logscore and number of views
+      plateau. `minutes` and `iterations` then only bound the analysis.
+  window : integer
+      With until='converged', the number of checkpoints over which a model
+      must be stable.
+  tolerance : float
+      With until='converged', the relative change in mean logscore between
+      successive windows below which a model has plateaued.
+  processes : integer
+      If specified, split the models among this many worker processes, each
+      analyzing its own copy of the bdb, and merge their results back in.
+  seed : integer
+      The entropy for the analysis, and with processes for the workers, so
+      that results are reproducible.
+  resume : bool
+      If True, ignore `minutes` and `iterations` and instead continue the
+      last analysis of the generator from its last checkpoint, towards its
+      original budget. Analyses by minutes or iterations are recorded in
+      the bdb and commit their progress at each checkpoint, so one that is
+      interrupted can be resumed.
+  background : bool
+      If True, run the analysis (by minutes or iterations, or resumed) in
+      another process on the same bdb file, and return a BackgroundAnalysis
+      handle at once. Meanwhile, queries see the models as of the
+      analysis's last checkpoint.
+  generators : list of str
+      If specified, analyze these generators instead, each in its own
+      worker process at the same time, so that `minutes` bounds the whole.
+      Returns the combined_analysis_status of the generators.
 
   Returns:
       A report indicating how many models have seen how many iterations,
-      and other info about model stability.
+      and other info about model stability, or, with background, the
+      BackgroundAnalysis.
   '''
   assert generator_name is not None
-  if models > 0:
+  if generators is not None:
+    if until is not None or resume or background:
+      raise BLE(ValueError('Cannot yet analyze several generators with '
+                           'until, resume or background.'))
+    if models > 0:
+      for generator in generators:
+        self.query('INITIALIZE %d MODELS IF NOT EXISTS FOR %s' %
+                   (models, generator))
+    from bdbcontrib import parallel
+    parallel.analyze_generators(self.bdb, generators, iterations=iterations,
+                                minutes=minutes, checkpoint=checkpoint,
+                                processes=processes, seed=seed)
+    if self.snapshot_path is not None:
+      self.snapshot()
+    return self.combined_analysis_status(generators)
+  generator_id = bayeslite.core.bayesdb_get_generator(self.bdb,
+                                                      generator_name)
+  # Resuming continues the job's models, so must not add any.
+  if models > 0 and not (resume and bayeslite.core.bayesdb_generator_modelnos(
+      self.bdb, generator_id)):
     self.query('INITIALIZE %d MODELS IF NOT EXISTS FOR %s' %
           (models, generator_name))
-    assert minutes == 0 or iterations == 0
+    assert minutes == 0 or iterations == 0 or until is not None
   else:
     models = self.analysis_status(generator_name=generator_name).sum()
-  if minutes > 0:
+  if background and (processes is not None or until is not None):
+    raise BLE(ValueError('Cannot yet analyze in the background with '
+                         'processes or until.'))
+  if resume:
+    if background:
+      return analyze_in_background(self.bdb, generator_name, seed=seed)
+    run_analysis_job(self.bdb, generator_name, processes=processes,
+                     on_checkpoint=self.checkpointed)
+  elif processes is not None and until is not None:
+    raise BLE(ValueError('Cannot yet analyze until converged in parallel.'))
+  elif until is not None:
+    if until != 'converged':
+      raise BLE(ValueError('Unknown analysis strategy until=%r. '
+                           'Try until="converged".' % (until,)))
+    analyze_until_converged(self, generator_name, minutes=minutes,
+                            iterations=iterations, checkpoint=checkpoint,
+                            window=window, tolerance=tolerance)
+  elif minutes > 0:
     if checkpoint == 0:
       checkpoint = max(1, int(minutes * models / 200))
-      analyzer = ('ANALYZE %s FOR %d MINUTES CHECKPOINT %d ITERATION WAIT' %
-                  (generator_name, minutes, checkpoint))
-      with logged_query(query_string=analyzer,
-                        name=self.session_capture_name,
-                        bindings=self.query('SELECT * FROM %t')):
-        self.query(analyzer)
+    start_analysis_job(self.bdb, generator_name, minutes=minutes,
+                       checkpoint=checkpoint, seed=seed)
+    if background:
+      return analyze_in_background(self.bdb, generator_name, seed=seed)
+    analyzer = ('ANALYZE %s FOR %d MINUTES CHECKPOINT %d ITERATION WAIT' %
+                (generator_name, minutes, checkpoint))
+    # Hashing the table is only worth it if the session is being logged.
+    fingerprint = ()
+    if self.session_capture_name:
+      fingerprint = table_fingerprint(self.bdb, self.name)
+    with logged_query(query_string=analyzer,
+                      name=self.session_capture_name,
+                      bindings=fingerprint):
+      run_analysis_job(self.bdb, generator_name, processes=processes,
+                       on_checkpoint=self.checkpointed)
   elif iterations > 0:
     if checkpoint == 0:
       checkpoint = max(1, int(iterations / 20))
-    self.query(
-        '''ANALYZE %s FOR %d ITERATIONS CHECKPOINT %d ITERATION WAIT''' % (
-            generator_name, iterations, checkpoint))
+    start_analysis_job(self.bdb, generator_name, iterations=iterations,
+                       checkpoint=checkpoint, seed=seed)
+    if background:
+      return analyze_in_background(self.bdb, generator_name, seed=seed)
+    run_analysis_job(self.bdb, generator_name, processes=processes,
+                     on_checkpoint=self.checkpointed)
   else:
     raise NotImplementedError('No default analysis strategy yet. '
                               'Please specify minutes or iterations.')
@@ -375,6 +794,8 @@ def analyze(self, models=100, minutes=0, iterations=0, checkpoint=0,
   # "the right thing" is, where that's something that at least isn't known to
   # suck.
 
+  if self.snapshot_path is not None:
+    self.snapshot()
   return self.analysis_status(generator_name=generator_name)
 
 @population_method(population=0, generator_name='generator_name')
@@ -405,6 +826,305 @@ def analysis_status(self, generator_name=None):
   self.status = vcs
   return vcs
 
+@population_method(population=0, generator_name='generator_name')
+def append_rows(self, df, iterations=0, generator_name=None):
+  '''Add new rows to the population's table without re-analyzing.
+
+  Every existing CrossCat model of the table takes in the new rows by
+  sampling their cluster in each of its views, keeping all else that it has
+  learned, so this costs time proportional to the number of new rows.
+
+  df : pandas.DataFrame
+      The new rows, with columns among those of the table.
+  iterations : integer
+      If positive, afterwards analyze the models this many more iterations
+      to let them adjust to the new rows.
+
+  Returns:
+      The number of rows appended.
+  '''
+  assert generator_name is not None
+  from bdbcontrib import crosscat_utils
+  qt = sqlite3_quote_name(self.name)
+  with self.bdb.savepoint():
+    last_rowid = cursor_value(self.bdb.sql_execute(
+        'SELECT MAX(_rowid_) FROM %s' % (qt,)))
+    bayesdb_read_pandas_df(self.bdb, self.name, df, create=False)
+    rowids = [row[0] for row in self.bdb.sql_execute(
+        'SELECT _rowid_ FROM %s WHERE _rowid_ > ? ORDER BY _rowid_' % (qt,),
+        (last_rowid or 0,))]
+    generators = self.bdb.sql_execute('''
+        SELECT name FROM bayesdb_generator
+          WHERE tabname = ? AND metamodel = 'crosscat'
+    ''', (self.name,)).fetchall()
+    for (generator,) in generators:
+      crosscat_utils.incorporate_rows(self.bdb, generator, rowids)
+  if self.df is not None:
+    self.df = self.df.append(df, ignore_index=True)
+  if iterations > 0:
+    self.analyze(models=0, iterations=iterations,
+                 generator_name=generator_name)
+  return len(rowids)
+
+@population_method(population=0)
+def combined_analysis_status(self, generators):
+  """Return the count of models for each number of iterations run, indexed
+  by generator and iterations, for each of several generators."""
+  statuses = [self.analysis_status(generator_name=generator)
+              for generator in generators]
+  return pd.concat(statuses, keys=generators,
+                   names=['generator', 'iterations'])
+
+def modelset_bql(modelnos):
+  """Return a BQL model set, like '0-3, 7', naming the given models."""
+  ranges = []
+  for modelno in sorted(modelnos):
+    if ranges and ranges[-1][1] == modelno - 1:
+      ranges[-1][1] = modelno
+    else:
+      ranges.append([modelno, modelno])
+  return ', '.join('%d' % (low,) if low == high else '%d-%d' % (low, high)
+                   for low, high in ranges)
+
+def analyze_until_converged(self, generator_name, minutes=0, iterations=0,
+                            checkpoint=0, window=5, tolerance=0.01):
+  '''Analyze all models in increments until their diagnostics plateau.
+
+  Each increment runs `checkpoint` iterations of only those models that
+  have not yet plateaued (see diagnostic_utils.logscore_plateaued). Stops
+  when every model has plateaued, or when `iterations` or `minutes`, if
+  nonzero, are used up.
+
+  Sets self.convergence to a per-model report, logs how many
+  model-iterations were saved relative to running every model as long as
+  the longest-running one, and returns the report.
+  '''
+  if checkpoint == 0:
+    checkpoint = max(1, int(iterations / 20)) if iterations > 0 else 10
+  generator_id = bayeslite.core.bayesdb_get_generator(self.bdb, generator_name)
+  modelnos = bayeslite.core.bayesdb_generator_modelnos(self.bdb, generator_id)
+  active = list(modelnos)
+  ran = dict((modelno, 0) for modelno in modelnos)
+  deadline = time.time() + 60 * minutes if minutes > 0 else None
+  while active:
+    step = checkpoint
+    if iterations > 0:
+      step = min(step, iterations - ran[active[0]])
+    self.query('ANALYZE %s MODELS %s FOR %d ITERATIONS CHECKPOINT %d '
+               'ITERATION WAIT' % (generator_name, modelset_bql(active),
+                                   step, step))
+    for modelno in active:
+      ran[modelno] += step
+    self.checkpointed()
+    history = crosscat_diagnostics_history(self.bdb, generator_name, active)
+    active = [modelno for modelno in active
+              if not logscore_plateaued(history.get(modelno, []),
+                                        window=window, tolerance=tolerance)]
+    if iterations > 0 and active and ran[active[0]] >= iterations:
+      break
+    if deadline is not None and time.time() >= deadline:
+      break
+
+  history = crosscat_diagnostics_history(self.bdb, generator_name)
+  report = pd.DataFrame({
+      'modelno': modelnos,
+      'iterations': [ran[modelno] for modelno in modelnos],
+      'logscore': [history[m][-1][1] if m in history else None
+                   for m in modelnos],
+      'num_views': [history[m][-1][2] if m in history else None
+                    for m in modelnos],
+      'converged': [modelno not in active for modelno in modelnos],
+  }, columns=['modelno', 'iterations', 'logscore', 'num_views', 'converged'])
+  budget = iterations if iterations > 0 else max(ran.values() or [0])
+  baseline = budget * len(modelnos)
+  used = sum(ran.values())
+  rhat = gelman_rubin([[logscore for _, logscore, _ in history[m][-window:]]
+                       for m in modelnos if m in history])
+  self.logger.info(
+      "Converged %d of %d models. Ran %d of %d model-iterations, "
+      "saving %d (%.0f%%). Cross-model R-hat of logscore: %.3f.",
+      report['converged'].sum(), len(modelnos), used, baseline,
+      baseline - used, 100. * (baseline - used) / max(baseline, 1), rhat)
+  self.convergence = report
+  return report
+
+ANALYSIS_JOB_SCHEMA = ['''
+  CREATE TABLE IF NOT EXISTS bdbcontrib_analysis_job (
+    generator_id INTEGER NOT NULL PRIMARY KEY,
+    iterations INTEGER NOT NULL,
+    minutes REAL NOT NULL,
+    checkpoint INTEGER NOT NULL,
+    seed INTEGER NOT NULL,
+    elapsed REAL NOT NULL DEFAULT 0
+  )''', '''
+  CREATE TABLE IF NOT EXISTS bdbcontrib_analysis_job_model (
+    generator_id INTEGER NOT NULL,
+    modelno INTEGER NOT NULL,
+    target INTEGER NOT NULL,
+    PRIMARY KEY(generator_id, modelno)
+  )''']
+
+def start_analysis_job(bdb, generator_name, iterations=0, minutes=0,
+                       checkpoint=1, seed=0):
+  '''Record a new analysis job for the current models of a generator.
+
+  The job, replacing any earlier one for the generator, is to analyze each
+  model `iterations` more iterations, or to analyze all of them for
+  `minutes`, in increments of `checkpoint` iterations. Run it with
+  run_analysis_job.
+  '''
+  generator_id = bayeslite.core.bayesdb_get_generator(bdb, generator_name)
+  with bdb.savepoint():
+    for schema in ANALYSIS_JOB_SCHEMA:
+      bdb.sql_execute(schema)
+    bdb.sql_execute('''DELETE FROM bdbcontrib_analysis_job_model
+                       WHERE generator_id = ?''', (generator_id,))
+    bdb.sql_execute('''
+      INSERT OR REPLACE INTO bdbcontrib_analysis_job
+        (generator_id, iterations, minutes, checkpoint, seed, elapsed)
+        VALUES (?, ?, ?, ?, ?, 0)''',
+                    (generator_id, iterations, minutes, checkpoint, seed))
+    bdb.sql_execute('''
+      INSERT INTO bdbcontrib_analysis_job_model (generator_id, modelno, target)
+        SELECT generator_id, modelno, iterations + ?
+          FROM bayesdb_generator_model WHERE generator_id = ?''',
+                    (iterations, generator_id))
+
+def analysis_job(bdb, generator_id):
+  '''Return (iterations, minutes, checkpoint, seed, elapsed) of the
+  generator's analysis job, or None if it has none.'''
+  if cursor_value(bdb.sql_execute('''
+      SELECT COUNT(*) FROM sqlite_master
+        WHERE type = 'table' AND name = 'bdbcontrib_analysis_job' ''')) == 0:
+    return None
+  rows = bdb.sql_execute('''
+    SELECT iterations, minutes, checkpoint, seed, elapsed
+      FROM bdbcontrib_analysis_job WHERE generator_id = ?''',
+                         (generator_id,)).fetchall()
+  return tuple(rows[0]) if rows else None
+
+def run_analysis_job(bdb, generator_name, processes=None, on_checkpoint=None):
+  '''Run, or resume, the recorded analysis job of a generator.
+
+  Each increment of the job's checkpoint iterations is its own analysis,
+  committed before the job's progress is, so an interrupted job loses at
+  most one increment and resumes where it stopped. Each increment is
+  seeded from the job's seed and the models' progress, so resumed runs
+  reproduce uninterrupted ones. Without `processes`, a job by minutes
+  checks its deadline after every iteration. With `processes`, increments
+  run in worker processes, which stop only after whole increments, so a
+  job by minutes may overrun by one increment. Calls `on_checkpoint`, if
+  given, after each increment.
+  '''
+  generator_id = bayeslite.core.bayesdb_get_generator(bdb, generator_name)
+  job = analysis_job(bdb, generator_id)
+  if job is None:
+    raise BLE(ValueError('No analysis job to resume for %s.' %
+                         (generator_name,)))
+  (iterations, minutes, checkpoint, seed, elapsed) = job
+  while minutes == 0 or elapsed < 60 * minutes:
+    remaining = dict(bdb.sql_execute('''
+      SELECT j.modelno, j.target - m.iterations
+        FROM bdbcontrib_analysis_job_model AS j, bayesdb_generator_model AS m
+        WHERE j.generator_id = ? AND m.generator_id = j.generator_id
+          AND m.modelno = j.modelno''', (generator_id,)).fetchall())
+    if iterations > 0:
+      active = sorted(m for m in remaining if remaining[m] > 0)
+      if not active:
+        break
+      step = min([checkpoint] + [remaining[m] for m in active])
+    else:
+      active = sorted(remaining)
+      step = checkpoint
+    done = cursor_value(bdb.sql_execute('''
+      SELECT COALESCE(SUM(iterations), 0) FROM bayesdb_generator_model
+        WHERE generator_id = ?''', (generator_id,)))
+    start = time.time()
+    if processes is None:
+      bdb.py_prng.seed(seed + done)
+      bdb.np_prng.seed((seed + done) % 2**32)
+      # As ANALYZE does, but bounded by iterations and the deadline both.
+      metamodel = bayeslite.core.bayesdb_generator_metamodel(bdb, generator_id)
+      if minutes == 0:
+        metamodel.analyze_models(bdb, generator_id, modelnos=active,
+                                 iterations=step, ckpt_iterations=step)
+      else:
+        metamodel.analyze_models(bdb, generator_id, modelnos=active,
+                                 iterations=step,
+                                 max_seconds=60 * minutes - elapsed,
+                                 ckpt_iterations=1)
+    else:
+      from bdbcontrib import parallel
+      parallel.analyze_models(bdb, generator_name, modelnos=active,
+                              iterations=step, checkpoint=step,
+                              processes=processes, seed=seed + done)
+    elapsed += time.time() - start
+    bdb.sql_execute('''UPDATE bdbcontrib_analysis_job SET elapsed = ?
+                       WHERE generator_id = ?''', (elapsed, generator_id))
+    if on_checkpoint is not None:
+      on_checkpoint()
+
+BUSY_TIMEOUT_MS = 60000
+
+class BackgroundAnalysis(object):
+  '''Handle on an analysis job running in another process.
+
+  The process commits the models at each checkpoint, so queries made
+  meanwhile see a consistent set of models as of the last checkpoint.
+  '''
+
+  def __init__(self, process):
+    self.process = process
+
+  def is_alive(self):
+    return self.process.is_alive()
+
+  def wait(self, timeout=None):
+    '''Wait up to `timeout` seconds, or for good if None, for the analysis
+    to finish. Return whether it has.'''
+    self.process.join(timeout)
+    if self.process.is_alive():
+      return False
+    if self.process.exitcode != 0:
+      raise BLE(RuntimeError('Background analysis failed with exit code %r.'
+                             % (self.process.exitcode,)))
+    return True
+
+  def stop(self):
+    '''Stop the analysis. Resume it later with analyze(resume=True).'''
+    self.process.terminate()
+    self.process.join()
+
+def analyze_in_background(bdb, generator_name, seed=0):
+  '''Run the generator's recorded analysis job in another process.
+
+  Switches the bdb file to write-ahead logging, so that readers and the
+  analysis do not block one another, and returns a BackgroundAnalysis.
+  '''
+  if bdb.pathname is None or bdb.pathname == ':memory:':
+    raise BLE(ValueError('Background analysis needs a bdb file, '
+                         'not an in-memory bdb.'))
+  bdb.sql_execute('PRAGMA journal_mode = WAL')
+  bdb.sql_execute('PRAGMA busy_timeout = %d' % (BUSY_TIMEOUT_MS,))
+  process = multiprocessing.Process(
+      target=_run_analysis_job_in_process,
+      args=(bdb.pathname, generator_name, seed, bdb.metamodels.values()))
+  process.daemon = True
+  process.start()
+  return BackgroundAnalysis(process)
+
+def _run_analysis_job_in_process(pathname, generator_name, seed, metamodels):
+  # Model with the same metamodels as the parent, composer included.
+  bdb = bayesdb_open(pathname, builtin_metamodels=False,
+                     seed=struct.pack('<QQQQ', 0, 0, 0, seed))
+  try:
+    bdb.sql_execute('PRAGMA busy_timeout = %d' % (BUSY_TIMEOUT_MS,))
+    for metamodel in metamodels:
+      bayeslite.bayesdb_register_metamodel(bdb, metamodel)
+    run_analysis_job(bdb, generator_name)
+  finally:
+    bdb.close()
+
 def get_data_as_list(bdb, table_name, column_list=None):
     if column_list is None:
         sql = '''
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""A pool of read-only connections to one bdb file, for concurrent queries.
+
+A BayesDB connection serves one query at a time.  A ConnectionPool opens
+several more connections to the same file, in write-ahead-log mode so that
+they neither block nor are blocked by the one writer (e.g. a Population's
+own connection, analyzing), and hands them out one thread at a time::
+
+    pool = population.connection_pool(size=4)
+    # In any number of threads:
+    df = pool.query('ESTIMATE PREDICTIVE PROBABILITY OF x FROM %g LIMIT 10')
+
+Connections cannot cross process boundaries, so each process that wants
+concurrent readers should make its own pool.
+"""
+
+import contextlib
+import Queue
+
+import bayeslite
+from bayeslite.exception import BayesLiteException as BLE
+
+from bdbcontrib.bql_utils import cursor_to_df
+from bdbcontrib.population_method import population_method
+
+# How long a connection waits for the writer to release a lock.
+BUSY_TIMEOUT_MS = 60000
+
+# Bytes of the file each connection may memory-map.  Mapped pages are
+# shared among connections and processes through the OS page cache.
+MMAP_SIZE = 2**30
+
+class ConnectionPool(object):
+    """A fixed number of read-only BayesDB connections to one file.
+
+    Parameters
+    ----------
+    pathname : str
+        The bdb file.
+    size : int
+        How many connections to open.
+    metamodels : list of callables, optional
+        Each is called with each new bayeslite.BayesDB to register any
+        metamodels beyond the builtin ones, e.g.
+        ``lambda bdb: bayeslite.bayesdb_register_metamodel(bdb, Composer())``.
+    interpret_bql : callable, optional
+        Applied to each query string passed to `query`, e.g. to fill in
+        %t and %g.
+    mmap_size : int
+        Bytes of the file each connection may memory-map.
+    """
+
+    def __init__(self, pathname, size=4, metamodels=None, interpret_bql=None,
+                 mmap_size=MMAP_SIZE):
+        if pathname is None or pathname == ':memory:':
+            raise BLE(ValueError('Connection pools need a bdb file, '
+                                 'not an in-memory bdb.'))
+        if size < 1:
+            raise BLE(ValueError('Connection pools need at least one '
+                                 'connection, not %r.' % (size,)))
+        self.pathname = pathname
+        self.interpret_bql = interpret_bql
+        self._all = []
+        self._idle = Queue.Queue()
+        try:
+            for _ in range(size):
+                bdb = bayeslite.bayesdb_open(pathname)
+                self._all.append(bdb)
+                for register in metamodels or []:
+                    register(bdb)
+                bdb.sql_execute('PRAGMA busy_timeout = %d' % (BUSY_TIMEOUT_MS,))
+                bdb.sql_execute('PRAGMA mmap_size = %d' % (mmap_size,))
+                bdb.sql_execute('PRAGMA query_only = ON')
+                self._idle.put(bdb)
+        except:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._all)
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """Check out a connection for the duration of a with block.
+
+        Waits up to `timeout` seconds, or for good if None, for one to be
+        free.
+        """
+        try:
+            bdb = self._idle.get(timeout=timeout)
+        except Queue.Empty:
+            raise BLE(RuntimeError('No free connection in %.1f seconds.'
+                                   % (timeout,)))
+        try:
+            yield bdb
+        finally:
+            self._idle.put(bdb)
+
+    def query(self, bql, bindings=None, timeout=None):
+        """Run a BQL query on a free connection, returning a DataFrame."""
+        if self.interpret_bql is not None:
+            bql = self.interpret_bql(bql)
+        if bindings is None:
+            bindings = ()
+        with self.connection(timeout=timeout) as bdb:
+            return cursor_to_df(bdb.execute(bql, bindings))
+
+    def close(self):
+        """Close all the connections.  Checked-out ones become unusable."""
+        while self._all:
+            self._all.pop().close()
+
+@population_method(population=0)
+def connection_pool(self, size=4, metamodels=None):
+    """Open a pool of read-only connections to the population's bdb file.
+
+    Switches the file to write-ahead logging, so that the pool's readers
+    and the population's own connection, which remains the one to analyze
+    and change data with, do not wait on one another.  The pool's `query`
+    understands %t and %g.
+
+    size : int
+        How many concurrent queries to allow.
+    metamodels : list of callables, optional
+        Each registers metamodels beyond the builtin ones in a new
+        connection, given its bayeslite.BayesDB.
+    """
+    if self.bdb_path is None:
+        raise BLE(ValueError('Connection pools need a bdb file; this '
+                             'population is in memory.'))
+    self.bdb.sql_execute('PRAGMA journal_mode = WAL')
+    return ConnectionPool(self.bdb_path, size=size, metamodels=metamodels,
+                          interpret_bql=self.interpret_bql)
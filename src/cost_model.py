@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Rough predictions of how long BQL queries will take.
+
+Some queries cost far more than their text suggests: ``ESTIMATE SIMILARITY
+FROM PAIRWISE`` runs in time proportional to ``n^2 m v``, for ``n`` rows,
+``m`` models and ``v`` views per model, and ``ESTIMATE MUTUAL INFORMATION
+FROM PAIRWISE COLUMNS`` to ``c^2 m s``, for ``c`` columns and ``s`` Monte
+Carlo samples.  `explain_cost` classifies a query by the shape of work it
+implies, counts the units of work from the table and the models, and
+converts them to seconds at rates measured on a laptop, which are only
+good to an order of magnitude.
+"""
+
+import json
+import re
+
+import bayeslite.core
+from bayeslite import bql_quote_name
+from bayeslite.exception import BayesLiteException as BLE
+
+from bdbcontrib.diagnostic_utils import diagnostics_generator_id
+from bdbcontrib.population_method import population_method
+
+# Queries predicted to take longer than this many seconds are expensive.
+EXPENSIVE_SECONDS = 60
+
+# bayeslite's default number of samples per mutual information estimate.
+MUTUAL_INFORMATION_SAMPLES = 100
+
+# How many models' thetas to read to estimate the mean number of views.
+VIEW_SAMPLE_MODELS = 10
+
+# (shape, pattern, units of work as a function of the counts, seconds/unit)
+QUERY_SHAPES = [
+    ('pairwise_rows',
+     re.compile(r'\bFROM\s+PAIRWISE\s+(?!COLUMNS\b)', re.I),
+     lambda n, c, m, v: n * n * m * v, 4e-5),
+    ('pairwise_columns_mutual_information',
+     re.compile(r'\bMUTUAL\s+INFORMATION\b.*\bFROM\s+PAIRWISE\s+COLUMNS\b',
+                re.I | re.S),
+     lambda n, c, m, v: c * c * m * MUTUAL_INFORMATION_SAMPLES, 1e-5),
+    ('pairwise_columns',
+     re.compile(r'\bFROM\s+PAIRWISE\s+COLUMNS\b', re.I),
+     lambda n, c, m, v: c * c * m, 1e-5),
+    ('columns',
+     re.compile(r'\bFROM\s+COLUMNS\s+OF\b', re.I),
+     lambda n, c, m, v: c * m, 1e-5),
+    ('rows',
+     re.compile(r'^\s*(ESTIMATE|INFER)\b', re.I),
+     lambda n, c, m, v: n * m * v, 4e-5),
+]
+
+def query_shape(bql):
+    """Return the name of the shape of work `bql` implies, or None if it
+    involves no models."""
+    for (shape, pattern, _units, _rate) in QUERY_SHAPES:
+        if pattern.search(bql):
+            return shape
+    return None
+
+def is_pairwise(bql):
+    """Return whether `bql` estimates something for all pairs of rows or
+    columns, so may need `explain_cost` before running."""
+    shape = query_shape(bql)
+    return shape is not None and shape.startswith('pairwise')
+
+PAIRWISE_GENERATOR = re.compile(
+    r'\bFROM\s+PAIRWISE\s+(?:COLUMNS\s+OF\s+)?("?)(\w+)\1', re.I)
+
+def pairwise_generator(bql):
+    """Return the name of the generator a pairwise `bql` query estimates
+    from, or None if it names none."""
+    match = PAIRWISE_GENERATOR.search(bql)
+    return None if match is None else match.group(2)
+
+@population_method(population_to_bdb=0, interpret_bql=1,
+                   generator_name='generator_name')
+def explain_cost(bdb, bql, generator_name=None):
+    """Predict how long a BQL query will take, without running it.
+
+    Parameters
+    ----------
+    bdb : __population_to_bdb__
+    bql : __interpret_bql__
+    generator_name : __generator_name__
+
+    Returns
+    -------
+    cost : dict
+        The query's 'shape', the counts of 'rows', 'columns', 'models' and
+        mean 'views' per model it depends on, the 'units' of work they
+        imply, the predicted 'seconds', and whether that makes it
+        'expensive'.
+    """
+    shape = query_shape(bql)
+    generator_id = bayeslite.core.bayesdb_get_generator(bdb, generator_name)
+    table = bayeslite.core.bayesdb_generator_table(bdb, generator_id)
+    rows = bdb.sql_execute('SELECT COUNT(*) FROM %s'
+                           % (bql_quote_name(table),)).next()[0]
+    columns = bdb.sql_execute('''
+        SELECT COUNT(*) FROM bayesdb_generator_column WHERE generator_id = ?
+    ''', (generator_id,)).next()[0]
+    models = len(bayeslite.core.bayesdb_generator_modelnos(bdb, generator_id))
+    views = mean_views(bdb, generator_name)
+    units = 0
+    seconds = 0.
+    for (name, _pattern, units_of, rate) in QUERY_SHAPES:
+        if name == shape:
+            units = units_of(rows, columns, models, views)
+            seconds = units * rate
+    return {'shape': shape, 'rows': rows, 'columns': columns,
+            'models': models, 'views': views, 'units': units,
+            'seconds': seconds, 'expensive': seconds > EXPENSIVE_SECONDS}
+
+def mean_views(bdb, generator):
+    """Return the mean number of views in (a sample of) the generator's
+    crosscat models, or 1 if it has none or is not crosscat-based."""
+    try:
+        generator_id = diagnostics_generator_id(bdb, generator)
+    except BLE:
+        return 1.
+    thetas = bdb.sql_execute('''
+        SELECT theta_json FROM bayesdb_crosscat_theta
+            WHERE generator_id = ? ORDER BY modelno LIMIT ?
+    ''', (generator_id, VIEW_SAMPLE_MODELS)).fetchall()
+    if not thetas:
+        return 1.
+    return (sum(len(json.loads(theta)['X_L']['view_state'])
+                for (theta,) in thetas) / float(len(thetas)))
@@ -24,6 +24,8 @@ import seaborn as sns
 
 import bayeslite.core
 from bayeslite.exception import BayesLiteException as BLE
+from bayeslite.metamodels.crosscat import crosscat_value_to_code
+from bayeslite.sqlite3_util import sqlite3_quote_name
 from crosscat.utils import sample_utils as su
 
 from population_method import population_method
@@ -173,6 +175,137 @@ def get_metadata(bdb, generator_name, modelno):
         return json.loads(row[0])
 
 
+def crosscat_code(bdb, generator_id, M_c, colno, value):
+    """Return the crosscat code for table `value` of generator column `colno`.
+
+    Codes values exactly as bayeslite's crosscat metamodel does, so that
+    missing values are NaN. Raises BLE for a categorical value the models
+    have never seen.
+    """
+    try:
+        return crosscat_value_to_code(bdb, generator_id, M_c, colno, value)
+    except KeyError:
+        colname = bayeslite.core.bayesdb_generator_column_name(bdb,
+            generator_id, colno)
+        raise BLE(ValueError('Value %r of column %s is not among the models\' '
+            'categories. Reset and re-analyze to include it.'
+            % (value, colname)))
+
+
+def incorporate_row(M_c, X_L, X_D, row, prng):
+    """Add the crosscat-coded `row` to the model state X_L, X_D in place.
+
+    In each view, samples the row's cluster from its conditional given the
+    current partition and the row's values in that view's columns (a new
+    cluster with weight alpha), then updates the counts and sufficient
+    statistics. Nothing else about the state changes.
+    """
+    for view, view_state in enumerate(X_L['view_state']):
+        cols = get_cols_in_view(X_L, view)
+        counts = view_state['row_partition_model']['counts']
+        alpha = view_state['row_partition_model']['hypers']['alpha']
+        cluster_models = [su.create_cluster_model_from_X_L(M_c, X_L, view, c)
+            for c in range(len(counts) + 1)]
+        logps = np.log(np.array(counts + [alpha], dtype=float))
+        for cluster, cluster_model in enumerate(cluster_models):
+            for col in cols:
+                if not np.isnan(row[col]):
+                    logps[cluster] += \
+                        cluster_model[col].calc_element_predictive_logp(row[col])
+        p = np.exp(logps - np.max(logps))
+        cluster = int(prng.choice(len(p), p=p / np.sum(p)))
+        X_D[view].append(cluster)
+        if cluster == len(counts):
+            counts.append(0)
+        counts[cluster] += 1
+        for col in cols:
+            component_model = cluster_models[cluster][col]
+            if not np.isnan(row[col]):
+                component_model.insert_element(row[col])
+            # Crosscat names the view's columns by their names in M_c.
+            suffstats = view_state['column_component_suffstats'][
+                view_state['column_names'].index(
+                    M_c['idx_to_name'][str(col)])]
+            if cluster == len(suffstats):
+                suffstats.append(component_model.get_suffstats())
+            else:
+                suffstats[cluster] = component_model.get_suffstats()
+
+
+def incorporate_rows(bdb, generator_name, rowids):
+    """Add table rows `rowids` to every model of a crosscat generator.
+
+    The rows must follow all rows the models already cover, as freshly
+    appended rows do. They join the generator's subsample after its last
+    crosscat row, so crosscat's data matches the models. Costs time
+    proportional to the number of rows added, not to the size of the table.
+    Uses the bdb's random number generator.
+    """
+    generator_id = bayeslite.core.bayesdb_get_generator(bdb, generator_name)
+    table_name = bayeslite.core.bayesdb_generator_table(bdb, generator_id)
+    M_c = get_M_c(bdb, generator_name)
+    # Read the rows as bayeslite's crosscat metamodel reads its data.
+    columns = bdb.sql_execute('''
+        SELECT c.name, c.colno, gc.stattype
+            FROM bayesdb_column AS c,
+                bayesdb_generator AS g,
+                bayesdb_generator_column AS gc
+            WHERE g.id = ?
+                AND c.tabname = g.tabname
+                AND c.colno = gc.colno
+                AND gc.generator_id = g.id
+            ORDER BY c.colno ASC
+    ''', (generator_id,)).fetchall()
+    # Rowids are integers from the table, so safe to bind inline, however
+    # many there are.
+    cursor = bdb.sql_execute('SELECT _rowid_, %s FROM %s WHERE _rowid_ IN (%s)'
+        % (', '.join('CAST(%s AS %s)' % (sqlite3_quote_name(name),
+                    sqlite3_quote_name(bayeslite.core.bayesdb_stattype_affinity(
+                        bdb, stattype)))
+                for name, _colno, stattype in columns),
+            sqlite3_quote_name(table_name),
+            ', '.join('%d' % (rowid,) for rowid in rowids)))
+    values = dict((row[0], row[1:]) for row in cursor)
+    rows = [[crosscat_code(bdb, generator_id, M_c, colno, value)
+            for value, (_name, colno, _stattype)
+            in zip(values[rowid], columns)]
+        for rowid in rowids]
+    with bdb.savepoint():
+        next_row_id = bdb.sql_execute('''
+            SELECT COALESCE(MAX(cc_row_id) + 1, 0)
+                FROM bayesdb_crosscat_subsample WHERE generator_id = ?
+        ''', (generator_id,)).next()[0]
+        for n, rowid in enumerate(rowids):
+            bdb.sql_execute('''
+                INSERT INTO bayesdb_crosscat_subsample
+                    (generator_id, sql_rowid, cc_row_id)
+                    VALUES (?, ?, ?)
+            ''', (generator_id, rowid, next_row_id + n))
+        cursor = bdb.sql_execute('''
+            SELECT modelno, theta_json FROM bayesdb_crosscat_theta
+                WHERE generator_id = ?
+        ''', (generator_id,))
+        for modelno, theta_json in cursor.fetchall():
+            theta = json.loads(theta_json)
+            for row in rows:
+                incorporate_row(M_c, theta['X_L'], theta['X_D'], row,
+                    bdb.np_prng)
+            bdb.sql_execute('''
+                UPDATE bayesdb_crosscat_theta SET theta_json = ?
+                    WHERE generator_id = ? AND modelno = ?
+            ''', (json.dumps(theta), generator_id, modelno))
+    forget_thetas(bdb, generator_id)
+
+
+def forget_thetas(bdb, generator_id):
+    """Drop the bdb's cached crosscat thetas of `generator_id`.
+
+    Call after changing the generator's models behind bayeslite's back.
+    """
+    if bdb.cache is not None and 'crosscat' in bdb.cache:
+        bdb.cache['crosscat'].thetas.pop(generator_id, None)
+
+
 def get_row_probabilities(X_L, X_D, M_c, T, view):
     """Returns predictive probability of the data in each row of T in view."""
     num_rows = len(X_D[0])
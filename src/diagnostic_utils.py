@@ -277,6 +277,133 @@ def estimate_kl_divergence(bdb, generatorA, generatorB, targets=None,
     return kl / n_samples
 
 
+def diagnostics_generator_id(bdb, generator):
+    """Return the id of the generator whose crosscat diagnostics to read.
+
+    Composer generators do their analysis in an internal crosscat generator,
+    so the diagnostics for `generator` are recorded under that one.
+
+    Parameters
+    ----------
+    bdb : bayeslite.BayesDB
+        Active BayesDB instance.
+    generator : str
+        Name of generator.
+
+    Returns
+    -------
+    generator_id : int
+    """
+    generator_id = bayeslite.core.bayesdb_get_generator(bdb, generator)
+    metamodel = bayeslite.core.bayesdb_generator_metamodel(bdb, generator_id)
+    if metamodel.name() == 'composer':
+        generator_id = metamodel.cc_id(bdb, generator_id)
+    elif metamodel.name() != 'crosscat':
+        raise BLE(ValueError('No crosscat diagnostics for generator %s (%s).'
+            % (generator, metamodel.name())))
+    return generator_id
+
+
+def crosscat_diagnostics_history(bdb, generator, modelnos=None):
+    """Return the checkpointed logscore and view count of each model.
+
+    Parameters
+    ----------
+    bdb : bayeslite.BayesDB
+        Active BayesDB instance.
+    generator : str
+        Name of generator.
+    modelnos : list<int>, optional
+        Models whose history to return. Defaults to all models.
+
+    Returns
+    -------
+    history : dict(int:list<tuple>)
+        A dict mapping each modelno to its [(iterations, logscore,
+        num_views), ...] in checkpoint order.
+    """
+    generator_id = diagnostics_generator_id(bdb, generator)
+    sql = '''
+        SELECT modelno, iterations, logscore, num_views
+            FROM bayesdb_crosscat_diagnostics
+            WHERE generator_id = ?
+            ORDER BY modelno ASC, checkpoint ASC
+    '''
+    wanted = None if modelnos is None else set(modelnos)
+    history = {}
+    for modelno, iterations, logscore, num_views in \
+            bdb.sql_execute(sql, (generator_id,)):
+        if wanted is not None and modelno not in wanted:
+            continue
+        history.setdefault(modelno, []).append(
+            (iterations, logscore, num_views))
+    return history
+
+
+def logscore_plateaued(history, window=5, tolerance=0.01):
+    """Return True if a model's diagnostics history has stopped changing.
+
+    A model has plateaued if the mean logscore of its last `window`
+    checkpoints is within relative `tolerance` of the mean logscore of the
+    `window` checkpoints before those, and its number of views did not
+    change during the last `window` checkpoints.
+
+    Parameters
+    ----------
+    history : list<tuple>
+        [(iterations, logscore, num_views), ...] as returned for one model by
+        :func:`crosscat_diagnostics_history`.
+    window : int
+        Number of checkpoints to compare.
+    tolerance : float
+        Relative change in mean logscore below which a model has plateaued.
+    """
+    if len(history) < 2 * window:
+        return False
+    logscores = [logscore for _, logscore, _ in history]
+    recent = sum(logscores[-window:]) / float(window)
+    previous = sum(logscores[-2*window:-window]) / float(window)
+    if abs(recent - previous) > tolerance * max(abs(previous), 1e-12):
+        return False
+    views = set(num_views for _, _, num_views in history[-window:])
+    return len(views) == 1
+
+
+def gelman_rubin(chains):
+    """Estimate the potential scale reduction factor R-hat of `chains`.
+
+    Values near 1 suggest that the chains sample the same distribution.
+    Note: each crosscat model is a chain only of its own checkpoints, so this
+    is a coarse statistic when models have few checkpoints.
+
+    Parameters
+    ----------
+    chains : list<list<float>>
+        One list of (e.g. logscore) values per chain. Each chain is truncated
+        to the length of the shortest.
+
+    Returns
+    -------
+    rhat : float
+        NaN if there are fewer than two chains or fewer than two values per
+        chain.
+    """
+    length = min(len(chain) for chain in chains) if chains else 0
+    if len(chains) < 2 or length < 2:
+        return float('nan')
+    chains = [chain[-length:] for chain in chains]
+    means = [sum(chain) / float(length) for chain in chains]
+    grand_mean = sum(means) / float(len(chains))
+    between = length * sum((m - grand_mean)**2 for m in means) \
+        / (len(chains) - 1)
+    within = sum(sum((x - m)**2 for x in chain) / (length - 1)
+        for chain, m in zip(chains, means)) / len(chains)
+    if within == 0:
+        return 1. if between == 0 else float('inf')
+    pooled = (length - 1) / float(length) * within + between / float(length)
+    return math.sqrt(pooled / within)
+
+
 # TODO: Migrate from hooks/contrib_diagnostics. Need users run experiments?
 # def run_bdb_experiment(bdb, exp_args):
     # pass
@@ -45,6 +45,8 @@ from bayeslite.core import bayesdb_get_generator
 from bayeslite.metamodels.crosscat import CrosscatMetamodel
 from crosscat.LocalEngine import LocalEngine as CrosscatLocalEngine
 
+from bdbcontrib.bql_utils import restrict_models
+
 start_time = time.time()
 def log(msg, *irritants):
     logging.info("At %3.2fs " % (time.time() - start_time) + msg, *irritants)
@@ -145,12 +147,7 @@ def model_specs(model_schedule, model_skip, n_replications):
 def model_restriction(bdb, gen_name, spec, model_count):
     (low, high) = spec
     assert model_count >= high, "Not enough models in bdb"
-    with bdb.savepoint_rollback():
-        if low > 0:
-            bdb.execute('''DROP MODELS 0-%d FROM %s''' % (low-1, gen_name))
-        if model_count > high:
-            bdb.execute('''DROP MODELS %d-%d FROM %s'''
-                        % (high, model_count-1, gen_name))
+    with restrict_models(bdb, gen_name, range(low, high)):
         yield
 
 def incorporate(running, new):
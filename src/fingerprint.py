@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Fingerprints of tables, maintained incrementally in the bdb.
+
+A fingerprint summarizes a table by its shape, a hash of its schema and an
+order-independent hash of its rows, so that logs and caches can identify a
+dataset without carrying its contents around.  Rows appended since the
+last fingerprint are hashed on demand; updates, deletes and out-of-order
+inserts, noticed by triggers, cause a full rehash instead.
+"""
+
+import hashlib
+import struct
+
+from bayeslite.exception import BayesLiteException as BLE
+from bayeslite.sqlite3_util import sqlite3_quote_name
+
+from bdbcontrib.population_method import population_method
+
+FINGERPRINT_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS bdbcontrib_fingerprint (
+        tabname TEXT NOT NULL PRIMARY KEY,
+        schema TEXT NOT NULL,
+        columns INTEGER NOT NULL,
+        rows INTEGER NOT NULL,
+        max_rowid INTEGER NOT NULL,
+        content TEXT NOT NULL,
+        stale BOOLEAN NOT NULL DEFAULT 0
+    )
+'''
+
+MIN_ROWID = -2**63
+
+@population_method(population_to_bdb=0, population_name=1)
+def table_fingerprint(bdb, table):
+    """Return the fingerprint of a table, bringing it up to date.
+
+    Costs time proportional to the rows appended since the last call,
+    unless rows were changed or deleted in between.
+
+    Parameters
+    ----------
+    bdb : bayeslite.BayesDB
+        Active BayesDB instance.
+    table : str
+        Name of the table.
+
+    Returns
+    -------
+    fingerprint : dict
+        With keys 'table', 'rows', 'columns', 'schema' (a hex digest of the
+        column names and types) and 'content' (a hex digest of the rows,
+        independent of their order).
+    """
+    qt = sqlite3_quote_name(table)
+    with bdb.savepoint():
+        columns = [(row[1], row[2])
+            for row in bdb.sql_execute('PRAGMA table_info(%s)' % (qt,))]
+        if len(columns) == 0:
+            raise BLE(ValueError('No such table: %r' % (table,)))
+        schema = hashlib.md5(repr(columns)).hexdigest()
+        bdb.sql_execute(FINGERPRINT_SCHEMA)
+        # Dropping the table drops its triggers, and with them any notice
+        # of what happened to it since, so without them start afresh.
+        watched = fingerprint_triggers_exist(bdb, table)
+        guarantee_fingerprint_triggers(bdb, table)
+        previous = bdb.sql_execute('''
+            SELECT schema, rows, max_rowid, content, stale
+                FROM bdbcontrib_fingerprint WHERE tabname = ?
+        ''', (table,)).fetchall()
+        if watched and previous and previous[0][0] == schema and \
+                not previous[0][4]:
+            (_schema, nrows, max_rowid, content, _stale) = previous[0]
+            content = int(content, 16)
+        else:
+            (nrows, max_rowid, content) = (0, MIN_ROWID, 0)
+        cursor = bdb.sql_execute('''
+            SELECT _rowid_, * FROM %s WHERE _rowid_ > ? ORDER BY _rowid_
+        ''' % (qt,), (max_rowid,))
+        for row in cursor:
+            nrows += 1
+            max_rowid = row[0]
+            content = (content + row_digest(row[1:])) % 2**64
+        content = '%016x' % (content,)
+        bdb.sql_execute('''
+            INSERT OR REPLACE INTO bdbcontrib_fingerprint
+                (tabname, schema, columns, rows, max_rowid, content, stale)
+                VALUES (?, ?, ?, ?, ?, ?, 0)
+        ''', (table, schema, len(columns), nrows, max_rowid, content))
+    return {'table': table, 'rows': nrows, 'columns': len(columns),
+            'schema': schema, 'content': content}
+
+def row_digest(row):
+    """Return a 64-bit hash of the values in `row`, distinguishing types."""
+    digest = hashlib.md5()
+    for value in row:
+        if isinstance(value, unicode):
+            data = value.encode('utf-8')
+        elif isinstance(value, buffer):
+            data = str(value)
+        else:
+            data = repr(value)
+        digest.update('%s:%d:%s' % (type(value).__name__, len(data), data))
+    return struct.unpack('<Q', digest.digest()[:8])[0]
+
+def fingerprint_trigger_names(table):
+    """Return the names of the triggers watching `table` for changes."""
+    return ['bdbcontrib_fingerprint_%s_%s' % (event, table)
+        for event in ('update', 'delete', 'insert')]
+
+def fingerprint_triggers_exist(bdb, table):
+    """True iff all the triggers watching `table` are in place."""
+    names = fingerprint_trigger_names(table)
+    count = bdb.sql_execute('''
+        SELECT COUNT(*) FROM sqlite_master
+            WHERE type = 'trigger' AND tbl_name = ? AND name IN (?, ?, ?)
+    ''', [table] + names).next()[0]
+    return count == len(names)
+
+def guarantee_fingerprint_triggers(bdb, table):
+    """Make changes to `table` other than appends mark its fingerprint stale.
+    """
+    qt = sqlite3_quote_name(table)
+    literal = "'%s'" % (table.replace("'", "''"),)
+    mark_stale = '''
+        BEGIN
+            UPDATE bdbcontrib_fingerprint SET stale = 1 WHERE tabname = %s;
+        END
+    ''' % (literal,)
+    for name, (event, when) in zip(fingerprint_trigger_names(table), [
+            ('UPDATE', ''),
+            ('DELETE', ''),
+            ('INSERT', '''WHEN NEW._rowid_ <= (SELECT max_rowid
+                FROM bdbcontrib_fingerprint WHERE tabname = %s)'''
+                % (literal,))]):
+        trigger = sqlite3_quote_name(name)
+        bdb.sql_execute('CREATE TRIGGER IF NOT EXISTS %s AFTER %s ON %s %s %s'
+            % (trigger, event, qt, when, mark_stale))
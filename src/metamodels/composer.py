@@ -14,7 +14,14 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import atexit
+import collections
+import multiprocessing as mp
+import os
+import shutil
 import sqlite3
+import tempfile
+import weakref
 
 import numpy as np
 
@@ -28,6 +35,9 @@ from crosscat.utils import sample_utils as su
 
 import bayeslite.metamodel
 
+from bdbcontrib import storage_utils
+from bdbcontrib.predictors import predictor as fp
+
 composer_schema_1 = [
 '''
 INSERT INTO bayesdb_metamodel
@@ -118,11 +128,212 @@ BEGIN
 END;
 ''']
 
+# Largest pool of weighted samples simulate resamples from at once.
+SIR_MAX_POOL = 10000
+
+# Mutual information draws evaluated together, and the default standard
+# error at which estimates stop drawing more: none, so that estimates spend
+# every sample asked for unless early stopping is asked for too.
+MI_BATCH = 20
+MI_TOLERANCE = 0
+
+# The composer and bdb of a model worker process, see Composer.map_models.
+_model_worker = {}
+
+def _model_worker_init(builders, n_samples, mi_tolerance, confidence):
+    composer = Composer(n_samples=n_samples, mi_tolerance=mi_tolerance,
+        confidence=confidence)
+    for builder in builders:
+        composer.register_foreign_predictor(builder)
+    _model_worker.update(bdb=None, pathname=None, composer=composer)
+
+def _model_worker_open(pathname):
+    if _model_worker['bdb'] is not None:
+        _model_worker['savepoint'].__exit__(None, None, None)
+        _model_worker['bdb'].close()
+    bdb = bayeslite.bayesdb_open(pathname=pathname)
+    bayeslite.bayesdb_register_metamodel(bdb, _model_worker['composer'])
+    # Hold one transaction open for as long as the copy is current, so that
+    # the compiled network, predictors and memos in bdb.cache outlive a task.
+    savepoint = bdb.savepoint()
+    savepoint.__enter__()
+    _model_worker.update(bdb=bdb, pathname=pathname, savepoint=savepoint)
+
+def _model_worker_run(pathname, method, genid, modelno, args, seed):
+    if pathname != _model_worker['pathname']:
+        _model_worker_open(pathname)
+    bdb = _model_worker['bdb']
+    _seed_prngs(bdb, seed)
+    return getattr(_model_worker['composer'], method)(bdb, genid, modelno,
+        *args)
+
+# Tables holding the models. Any change to them, by whatever means,
+# retires the copies in the worker processes of Composer.map_models.
+MODEL_TABLES = ('bayesdb_generator_model', 'bayesdb_crosscat_theta',
+    'bayesdb_crosscat_subsample')
+
+def _count_model_changes(bdb):
+    # Count changes to the models through this connection with temporary
+    # triggers. The count is kept in Python, not in a table, so that rolling
+    # back a change cannot bring back a count already used for it.
+    changes = [0]
+    def changed():
+        changes[0] += 1
+    storage_utils.sqlite3_connection(bdb).createscalarfunction(
+        'bdbcontrib_composer_models_changed', changed, 0)
+    for table in MODEL_TABLES:
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            bdb.sql_execute('''
+                CREATE TEMP TRIGGER IF NOT EXISTS %s AFTER %s ON main.%s
+                BEGIN
+                    SELECT bdbcontrib_composer_models_changed();
+                END
+            ''' % (quote('bdbcontrib_composer_%s_%s' % (event.lower(), table)),
+                event, quote(table)))
+    return changes
+
+# Crosscat draws from bdb.py_prng and the composer from bdb.np_prng, so
+# sharing or replaying random numbers takes both.
+def _seed_prngs(bdb, seed):
+    bdb.np_prng.seed(seed)
+    bdb.py_prng.seed(seed)
+
+def _prng_state(bdb):
+    return (bdb.np_prng.get_state(), bdb.py_prng.getstate())
+
+def _set_prng_state(bdb, state):
+    np_state, py_state = state
+    bdb.np_prng.set_state(np_state)
+    bdb.py_prng.setstate(py_state)
+
+# Rowids bound into one query when reading rows for prediction.
+ROWS_PER_QUERY = 500
+
+# Grid points at which kde_confidence evaluates the density: more is more
+# accurate and slower.
+KDE_GRID = 64
+
+def kde_confidence(samples, grid=KDE_GRID):
+    """Confidence in the mean of numerical `samples`, by kernel density.
+
+    Estimates the density of `samples` with a Gaussian kernel at `grid`
+    points, and returns the share of its mass in the basin of the highest
+    mode: 1 for unimodal samples, about 1/k for k even, well separated
+    modes.  This approximates the largest weight of a mixture fitted to
+    the samples, which :func:`dpgmm_confidence` computes at much greater
+    cost.
+    """
+    samples = np.asarray(samples, dtype=float)
+    scale = np.std(samples)
+    if len(samples) < 2 or scale == 0:
+        return 1.
+    # Silverman's rule of thumb.
+    bandwidth = 1.06 * scale * len(samples) ** -0.2
+    xs = np.linspace(samples.min() - 3*bandwidth,
+        samples.max() + 3*bandwidth, grid)
+    z = (xs[:,np.newaxis] - samples[np.newaxis,:]) / bandwidth
+    density = np.exp(-0.5 * z**2).sum(axis=1)
+    # Walk down from the highest mode until the density rises again.
+    lo = hi = np.argmax(density)
+    while 0 < lo and density[lo-1] <= density[lo]:
+        lo -= 1
+    while hi < grid-1 and density[hi+1] <= density[hi]:
+        hi += 1
+    return density[lo:hi+1].sum() / density.sum()
+
+def dpgmm_confidence(samples, n_steps=1000):
+    """Confidence in the mean of numerical `samples`, by fitted mixture.
+
+    Returns the largest weight of a Dirichlet process Gaussian mixture fit
+    to `samples` in `n_steps` steps: fewer steps is faster and less
+    accurate.
+    """
+    # XXX The definition of confidence is P[k=1] where
+    # k=1 is the number of mixture componets (we need a distribution
+    # over GPMM to answer this question). The confidence is instead
+    # implemented as \max_i{p_i} where p_i are the weights of a
+    # fitted DPGMM.
+    return su.continuous_imputation_confidence(list(samples), None, None,
+        n_steps=n_steps)
+
+def _most_frequent(samples):
+    return collections.Counter(_python_value(v) for v in samples)\
+        .most_common(1)[0][0]
+
+def _python_value(value):
+    # Unwrap numpy scalars from sample arrays into plain Python values.
+    return value.item() if isinstance(value, np.generic) else value
+
+class CompiledComposer(object):
+    """The catalog metadata of one composer generator, read in one go.
+
+    Inference visits the foreign predictor network once per sample, so
+    :class:`Composer` reads the network from the catalog once per
+    transaction and answers from this structure thereafter.
+    """
+
+    def __init__(self, bdb, genid):
+        self.cc_id = bdb.sql_execute('''
+            SELECT crosscat_generator_id FROM bayesdb_composer_cc_id
+                WHERE generator_id = ?
+        ''', (genid,)).fetchall()[0][0]
+        self.cc = core.bayesdb_generator_metamodel(bdb, self.cc_id)
+        # Local and foreign column numbers.
+        self.lcols = set()
+        self.fcols = set()
+        for colno, local in bdb.sql_execute('''
+                SELECT colno, local FROM bayesdb_composer_column_owner
+                    WHERE generator_id = ?
+                ''', (genid,)):
+            (self.lcols if local else self.fcols).add(colno)
+        # Column names and stattypes, and the crosscat column number of
+        # each local column.
+        self.colnames = {}
+        self.stattypes = {}
+        for colno, name, stattype in self._modelled_columns(bdb, genid):
+            self.colnames[colno] = name
+            self.stattypes[colno] = stattype
+        cc_columns = self._modelled_columns(bdb, self.cc_id)
+        cc_colnos = {casefold(name): colno for colno, name, _ in cc_columns}
+        self.cc_colnos = {colno: cc_colnos[casefold(self.colnames[colno])]
+                          for colno in self.lcols}
+        # Sorted parents of each foreign column.
+        self.parents = {fcol: [] for fcol in self.fcols}
+        for fcol, pcol in bdb.sql_execute('''
+                SELECT fcolno, pcolno FROM bayesdb_composer_column_parents
+                    WHERE generator_id = ?
+                    ORDER BY fcolno ASC, pcolno ASC
+                ''', (genid,)):
+            self.parents[fcol].append(pcol)
+        self.pcols = {fcol: set(pcols)
+                      for fcol, pcols in self.parents.iteritems()}
+        self.topo = [row[0] for row in bdb.sql_execute('''
+            SELECT colno FROM bayesdb_composer_column_toposort
+                WHERE generator_id = ?
+                ORDER BY position ASC
+        ''', (genid,))]
+        self.predictor_names = dict(bdb.sql_execute('''
+            SELECT colno, predictor_name
+                FROM bayesdb_composer_column_foreign_predictor
+                WHERE generator_id = ?
+        ''', (genid,)))
+
+    @staticmethod
+    def _modelled_columns(bdb, genid):
+        return bdb.sql_execute('''
+            SELECT c.colno, c.name, gc.stattype
+                FROM bayesdb_generator AS g, bayesdb_generator_column AS gc,
+                    bayesdb_column AS c
+                WHERE g.id = ? AND gc.generator_id = g.id
+                    AND c.tabname = g.tabname AND c.colno = gc.colno
+        ''', (genid,))
+
 class Composer(bayeslite.metamodel.IBayesDBMetamodel):
     """A metamodel which composes foreign predictors with CrossCat.
     """
 
-    def __init__(self, n_samples=None):
+    def __init__(self, n_samples=None, mi_tolerance=None, processes=None,
+            confidence=None):
         # In-memory map of registered foreign predictor builders.
         self.predictor_builder = {}
         self.predictor_cache = {}
@@ -132,6 +343,26 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         else:
             assert 0 < n_samples
             self.n_samples = n_samples
+        # Standard error at which mutual information estimates stop
+        # sampling early; 0, the default, always spends every sample.
+        if mi_tolerance is None:
+            self.mi_tolerance = MI_TOLERANCE
+        else:
+            assert 0 <= mi_tolerance
+            self.mi_tolerance = mi_tolerance
+        # Confidence in the imputation of numerical columns, a function of
+        # the samples, such as functools.partial(dpgmm_confidence,
+        # n_steps=100) to trade accuracy for speed differently.
+        if confidence is None:
+            self.confidence = kde_confidence
+        else:
+            self.confidence = confidence
+        # Worker processes over which to spread per-model work, if any.
+        self.processes = processes
+        self.model_pool = None
+        self.model_pool_atexit = False
+        # Count of changes to the models of each bdb registered with.
+        self.model_changes = weakref.WeakKeyDictionary()
 
     def _predictor_cache(self, bdb):
         assert bdb.cache is not None
@@ -142,6 +373,86 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
             bdb.cache['composer'] = comp_cache
             return comp_cache
 
+    def compiled(self, bdb, genid):
+        """Return the :class:`CompiledComposer` for generator `genid`.
+
+        Outside a transaction the catalog is read afresh every time.
+        """
+        if bdb.cache is None:
+            return CompiledComposer(bdb, genid)
+        # Kept beside the predictors, so drop_generator discards it too.
+        cache = self._predictor_cache(bdb)
+        if (genid, 'compiled') not in cache:
+            cache[(genid, 'compiled')] = CompiledComposer(bdb, genid)
+        return cache[(genid, 'compiled')]
+
+    def map_models(self, bdb, genid, method, modelnos, *args):
+        """Call `method` of this composer for each of `modelnos`.
+
+        Returns the list of ``getattr(self, method)(bdb, genid, modelno,
+        *args)``.  With `processes`, and more than one model, the calls run
+        in a pool of worker processes, each holding its own copy of `bdb`
+        and its own foreign predictors, and each call draws from its own
+        random streams seeded from `bdb`.  The copy is taken when the pool
+        starts, and taken again whenever the models have changed since,
+        however they were changed; the workers reopen it with their next
+        call.
+        """
+        if not self.processes or len(modelnos) < 2:
+            return [getattr(self, method)(bdb, genid, modelno, *args)
+                    for modelno in modelnos]
+        pool, pathname = self._model_pool(bdb)
+        seeds = bdb.np_prng.randint(2**31 - 1, size=len(modelnos))
+        jobs = [pool.apply_async(_model_worker_run,
+                                 (pathname, method, genid, modelno, args,
+                                  int(seed)))
+                for modelno, seed in zip(modelnos, seeds)]
+        return [job.get() for job in jobs]
+
+    def _models_version(self, bdb):
+        # Changes through this connection are counted, and commits through
+        # other connections bump the data version.
+        data_version = bdb.sql_execute('PRAGMA data_version').next()[0]
+        return (self.model_changes[bdb][0], data_version)
+
+    def _model_pool(self, bdb):
+        if self.model_pool is not None and self.model_pool[0] is not bdb:
+            self.close_model_pool()
+        if self.model_pool is None:
+            tempdir = tempfile.mkdtemp(prefix='bdbcontrib-composer-')
+            pool = mp.Pool(processes=self.processes,
+                initializer=_model_worker_init,
+                initargs=(self.predictor_builder.values(), self.n_samples,
+                          self.mi_tolerance, self.confidence))
+            if not self.model_pool_atexit:
+                atexit.register(self.close_model_pool)
+                self.model_pool_atexit = True
+            self.model_pool = (bdb, None, pool, tempdir, os.getpid(), None)
+        _bdb, version, pool, tempdir, pid, pathname = self.model_pool
+        if version != self._models_version(bdb):
+            version = self._models_version(bdb)
+            stale = pathname
+            pathname = os.path.join(tempdir, 'models-%d-%d.bdb' % version)
+            storage_utils.backup_bdb(bdb, pathname)
+            # No call is in flight, and a worker still holding the stale
+            # copy open keeps it until it reopens.
+            if stale is not None:
+                os.remove(stale)
+            self.model_pool = (bdb, version, pool, tempdir, pid, pathname)
+        return pool, pathname
+
+    def close_model_pool(self):
+        """Stop the worker processes of :meth:`map_models`, if any."""
+        if self.model_pool is not None:
+            _bdb, _version, pool, tempdir, pid, _pathname = self.model_pool
+            self.model_pool = None
+            if pid != os.getpid():
+                # A forked copy of this composer: the pool is the parent's.
+                return
+            pool.terminate()
+            pool.join()
+            shutil.rmtree(tempdir, ignore_errors=True)
+
     def register_foreign_predictor(self, builder):
         """Register an object which builds a foreign predictor.
 
@@ -201,6 +512,7 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
             with bdb.savepoint():
                 for stmt in composer_schema_1:
                     bdb.sql_execute(stmt)
+        self.model_changes[bdb] = _count_model_changes(bdb)
         return
 
     def create_generator(self, bdb, table, schema, instantiate):
@@ -273,12 +585,13 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
 
     def drop_generator(self, bdb, genid):
         with bdb.savepoint():
+            # Obtain before losing references.
+            cc_name = core.bayesdb_generator_name(bdb, self.cc_id(bdb, genid))
             # Clear caches.
+            self.close_model_pool()
             keys = [k for k in self._predictor_cache(bdb) if k[0] == genid]
             for k in keys:
                 del self._predictor_cache(bdb)[k]
-            # Obtain before losing references.
-            cc_name = core.bayesdb_generator_name(bdb, self.cc_id(bdb, genid))
             # Delete tables reverse order of insertion.
             bdb.sql_execute('''
                 DELETE FROM bayesdb_composer_column_foreign_predictor
@@ -311,6 +624,7 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         # of a sequence of models up to the requested number of them,
         # and BayesDB computes the numbers that need to be filled in.
         # The inverse of that computation is max(modelnos)+1.
+        self._forget_evidence(bdb, genid)
         qg = quote(core.bayesdb_generator_name(bdb, self.cc_id(bdb, genid)))
         bql = 'INITIALIZE {} MODELS FOR {};'.format(max(modelnos)+1, qg)
         bdb.execute(bql)
@@ -344,6 +658,7 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
                 })
 
     def drop_models(self, bdb, genid, modelnos=None):
+        self._forget_evidence(bdb, genid)
         qg = quote(core.bayesdb_generator_name(bdb, self.cc_id(bdb, genid)))
         if modelnos is not None:
             models = ",".join(str(modelno) for modelno in modelnos)
@@ -354,6 +669,7 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
 
     def analyze_models(self, bdb, genid, modelnos=None, iterations=1,
                 max_seconds=None, ckpt_iterations=None, ckpt_seconds=None):
+        self._forget_evidence(bdb, genid)
         # XXX Composer currently does not perform joint inference.
         # (Need full GPM interface, active research project).
         self.cc(bdb, genid).analyze_models(bdb, self.cc_id(bdb, genid),
@@ -382,9 +698,9 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         else:
             modelnos = [modelno]
         with bdb.savepoint():
-            p = sum(self._column_dependence_probability(
-                     bdb, genid, m, colno0, colno1)
-                    for m in modelnos) / float(len(modelnos))
+            p = sum(self.map_models(bdb, genid,
+                    '_column_dependence_probability', modelnos, colno0,
+                    colno1)) / float(len(modelnos))
         return p
 
     def _column_dependence_probability(self, bdb, genid, modelno, colno0,
@@ -448,9 +764,9 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         else:
             modelnos = [modelno]
         with bdb.savepoint():
-            mi = sum(self.conditional_mutual_information(
-                      bdb, genid, modelno, X, W, Z, Y)
-                     for modelno in modelnos) / float(len(modelnos))
+            mi = sum(self.map_models(bdb, genid,
+                     '_conditional_mutual_information', modelnos, X, W, Z, Y,
+                     numsamples)) / float(len(modelnos))
         return mi
 
     def conditional_mutual_information(self, bdb, genid, modelno, X, W, Z, Y,
@@ -474,28 +790,37 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
             raise BLE(ValueError('Duplicate cells received in '
                 'conditional_mutual_information.\n'
                 'X: {}\nW: {}\nZ: {}\nY: {}'.format(X, W, Z, Y)))
-        # Simulate from joint.
-        XWZ_samples = self.simulate(bdb, genid, modelno, X+W+Z,
-            Y, numpredictions=numsamples)
-        # Simple Monte Carlo
-        mi = logpz = logpxwz = logpxz = logpwz = 0
-        for s in XWZ_samples:
-            Qx = [(r,c,v) for ((r,c),v) in zip(X, s[:len(X)])]
-            Qw = [(r,c,v) for ((r,c),v) in zip(W, s[len(X):len(X)+len(W)])]
-            Qz = [(r,c,v) for ((r,c),v) in zip(Z, s[len(X)+len(W):])]
-            if Z:
-                logpz = self._joint_logpdf(bdb, genid, modelno, Qz, Y)
-            else:
-                logpz = 0
-            logpxwz = self._joint_logpdf(bdb, genid, modelno, Qx+Qw+Qz, Y)
-            logpxz = self._joint_logpdf(bdb, genid, modelno, Qx+Qz, Y)
-            logpwz = self._joint_logpdf(bdb, genid, modelno, Qw+Qz, Y)
-            mi += logpz + logpxwz - logpxz - logpwz
+        # Simple Monte Carlo over joint draws of X, W and Z, in batches:
+        # mi = logpz + logpxwz - logpxz - logpwz, each term evaluated for
+        # the whole batch at once. Stop once the standard error of the
+        # estimate is within self.mi_tolerance.
+        XWZ = X + W + Z
+        terms = [(X+W+Z, 1), (X+Z, -1), (W+Z, -1)]
+        if Z:
+            terms.append((Z, 1))
+        mi = []
+        while len(mi) < numsamples:
+            batch = min(MI_BATCH, numsamples - len(mi))
+            XWZ_samples = self.simulate(bdb, genid, modelno, XWZ, Y,
+                numpredictions=batch)
+            # The terms of each draw share random numbers.
+            seeds = bdb.np_prng.randint(2**31 - 1, size=batch)
+            mi_batch = np.zeros(batch)
+            for cells, sign in terms:
+                positions = [XWZ.index(cell) for cell in cells]
+                Qs = [[(r, c, s[i]) for (r, c), i in zip(cells, positions)]
+                      for s in XWZ_samples]
+                mi_batch += sign * self._joint_logpdfs(bdb, genid, modelno,
+                    Qs, Y, seeds)
+            mi.extend(mi_batch)
+            if 1 < len(mi) and \
+                    np.std(mi, ddof=1) / np.sqrt(len(mi)) < self.mi_tolerance:
+                break
         # TODO: linfoot?
         # TODO: If negative, report to user that reliable answer cannot be
         # returned with current `numsamples`.
         # Averaging is in direct space is correct.
-        return mi/numsamples
+        return np.mean(mi)
 
     def logpdf_joint(self, bdb, generator_id, targets, constraints, modelno):
         if modelno is None:
@@ -503,13 +828,15 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         else:
             modelnos = [modelno]
         with bdb.savepoint():
-            return logmeanexp([self._joint_logpdf(bdb, generator_id, modelno,
-                targets, constraints) for modelno in modelnos])
+            return logmeanexp(self.map_models(bdb, generator_id,
+                '_joint_logpdf', modelnos, targets, constraints))
 
-    def _joint_logpdf(self, bdb, genid, modelno, Q, Y, n_samples=None):
+    def _joint_logpdf(self, bdb, genid, modelno, Q, Y, n_samples=None,
+            seed=None):
         # XXX Computes the joint probability of query Q given evidence Y
         # for a single model. The function is a likelihood weighted
-        # integrator.
+        # integrator. If `seed` is given, the random numbers are drawn
+        # from it.
         # XXX Determine.
         if n_samples is None:
             n_samples = self.n_samples
@@ -522,20 +849,123 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         Q = self._queries_consistent_with_constraints(Q, Y)
         if Q is None:
             return float('-inf')
+        if not Q:
+            # The evidence already fixes every query cell.
+            return 0
         for r, _, _ in Q+Y:
             assert r == Q[0][0], "Cannot assess more than one row, "\
                 "%s and %s requested" % (Q[0][0], r)
-        # (Q,Y) marginal joint density.
+        logp = self._exact_joint_logpdf(bdb, genid, modelno, Q, Y)
+        if logp is not None:
+            return logp
+        # Y marginal density. The (Q,Y) marginal joint density reuses the
+        # random numbers drawn for it: with common random numbers, much of
+        # the noise in the two estimates cancels. Seeded, it depends only
+        # on the evidence and the seed, so is memoized for the rest of the
+        # query.
+        def logpdf_evidence():
+            _, Y_weights = self._weighted_sample(bdb, genid, modelno,
+                Q[0][0], Y, n_samples=n_samples)
+            return logmeanexp(Y_weights)
+        if seed is None:
+            state = _prng_state(bdb)
+            logpY = logpdf_evidence()
+            _set_prng_state(bdb, state)
+        else:
+            _seed_prngs(bdb, seed)
+            logpY = self._memoize_evidence(bdb, genid,
+                ('logpdf', modelno, n_samples, seed, tuple(sorted(Y))),
+                logpdf_evidence)
+            _seed_prngs(bdb, seed)
         _, QY_weights = self._weighted_sample(bdb, genid, modelno,
             Q[0][0], Q+Y, n_samples=n_samples)
-        # Y marginal density.
-        _, Y_weights = self._weighted_sample(bdb, genid, modelno,
-            Q[0][0], Y, n_samples=n_samples)
         # XXX TODO Keep sampling until logpQY <= logpY
         logpQY = logmeanexp(QY_weights)
-        logpY = logmeanexp(Y_weights)
         return logpQY - logpY
 
+    def _joint_logpdfs(self, bdb, genid, modelno, Qs, Y, seeds):
+        # Computes _joint_logpdf of each query in Qs, which all name the
+        # same cells, given the evidence Y: exactly in one vectorized pass
+        # if the network allows, else by sampling, seeding the random
+        # numbers for each query from `seeds`. Leaves the bdb's random
+        # number generators as it found them.
+        logps = self._exact_joint_logpdfs(bdb, genid, modelno, Qs, Y)
+        if logps is None:
+            logps = np.zeros(len(Qs))
+            state = _prng_state(bdb)
+            try:
+                for k, (Q, seed) in enumerate(zip(Qs, seeds)):
+                    logps[k] = self._joint_logpdf(bdb, genid, modelno, Q, Y,
+                        seed=seed)
+            finally:
+                _set_prng_state(bdb, state)
+        return logps
+
+    def _exact_joint_logpdf(self, bdb, genid, modelno, Q, Y):
+        logps = self._exact_joint_logpdfs(bdb, genid, modelno, [Q], Y)
+        return None if logps is None else logps[0]
+
+    def _exact_joint_logpdfs(self, bdb, genid, modelno, Qs, Y):
+        # Computes log p(Q|Y) exactly for each query Q in Qs, which all
+        # name the same cells, when every foreign column in Y has all its
+        # parents in Y, and every foreign column in Q has all its parents
+        # in Q or Y. Then no unobserved column is the parent of an observed
+        # one, and the density factors into CrossCat's exact
+        # p(Q_local|Y_local) times the foreign predictors' densities of
+        # the foreign columns in Q given their parents. Returns None
+        # otherwise, for the caller to estimate by sampling.
+        compiled = self.compiled(bdb, genid)
+        Y_values = {c:v for _,c,v in Y}
+        colnos = [c for _,c,_ in Qs[0]]
+        if any(c in compiled.fcols and
+                not compiled.pcols[c].issubset(Y_values) for c in Y_values):
+            return None
+        known = set(Y_values).union(colnos)
+        if any(c in compiled.fcols and
+                not compiled.pcols[c].issubset(known) for c in colnos):
+            return None
+        logps = np.zeros(len(Qs))
+        if any(c in compiled.lcols for c in colnos):
+            Y_cc = [(r, compiled.cc_colnos[c], v) for r,c,v in Y
+                    if c in compiled.lcols]
+            logps += [compiled.cc.logpdf_joint(bdb, compiled.cc_id,
+                    [(r, compiled.cc_colnos[c], v) for r,c,v in Q
+                     if c in compiled.lcols],
+                    Y_cc, modelno)
+                for Q in Qs]
+        def values(c):
+            # The value of column c in every query, or else the evidence.
+            if c in colnos:
+                i = colnos.index(c)
+                return np.asarray([Q[i][2] for Q in Qs])
+            return np.asarray([Y_values[c]] * len(Qs))
+        for fcol in colnos:
+            if fcol in compiled.fcols:
+                conditions = {compiled.colnames[c]: values(c)
+                    for c in compiled.parents[fcol]}
+                logps += fp.logpdf_many(self.predictor(bdb, genid, fcol),
+                    values(fcol), conditions)
+        return logps
+
+    def _memoize_evidence(self, bdb, genid, key, compute):
+        # Terms which depend only on the evidence recur across the many
+        # density evaluations of one query, so remember them until the
+        # transaction ends or the models change.
+        if bdb.cache is None:
+            return compute()
+        cache = self._predictor_cache(bdb)
+        key = (genid, 'evidence') + key
+        if key not in cache:
+            cache[key] = compute()
+        return cache[key]
+
+    def _forget_evidence(self, bdb, genid):
+        if bdb.cache is None:
+            return
+        cache = self._predictor_cache(bdb)
+        for key in [k for k in cache if k[:2] == (genid, 'evidence')]:
+            del cache[key]
+
     def _queries_consistent_with_constraints(self, Q, Y):
         queries = dict()
         for (row, col, val) in Q:
@@ -565,81 +995,122 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
     def _predict_confidence(self, bdb, genid, modelno, colno, rowid,
             numsamples=None):
         # Predicts a value for the cell [rowid, colno] with a confidence metric.
+        return self._predict_confidence_batch(bdb, genid, modelno, colno,
+            [rowid], numsamples=numsamples)[0]
+
+    def predict_confidence_batch(self, bdb, genid, modelno, colno, rowids,
+            numsamples=None):
+        """Predict the cell [rowid, colno] of each of `rowids`.
+
+        Returns a list of (value, confidence) pairs, one for each rowid, as
+        :meth:`predict_confidence` would for each row alone. The rows are
+        read in a few queries, the missing parents of a foreign column are
+        imputed for all rows that lack them at once, and each foreign
+        predictor simulates every row's samples in one call.
+        """
+        with bdb.savepoint():
+            return self._predict_confidence_batch(bdb, genid, modelno, colno,
+                rowids, numsamples=numsamples)
+
+    def _predict_confidence_batch(self, bdb, genid, modelno, colno, rowids,
+            numsamples=None, rows=None):
         # XXX Prefer accuracy over speed for imputation.
         if numsamples is None:
             numsamples = self.n_samples
-        colnos = core.bayesdb_generator_column_numbers(bdb, genid)
-        colnames = core.bayesdb_generator_column_names(bdb, genid)
-        row = core.bayesdb_generator_row_values(bdb, genid, rowid)
-        # Account for multiple imputations if imputing parents.
-        parent_conf = 1
+        compiled = self.compiled(bdb, genid)
+        if rows is None:
+            rows = self._row_values(bdb, genid, rowids)
         # Predicting lcol.
-        if colno in self.lcols(bdb, genid):
-            # Delegate to CC IFF
-            # (lcol has no children OR all its children are None).
-            children = [f for f in self.fcols(bdb, genid) if colno in
-                    self.pcols(bdb, genid, f)]
-            if len(children) == 0 or \
-                    all(row[i] is None for i in xrange(len(row)) if i+1
-                        in children):
-                return self.cc(bdb, genid).predict_confidence(bdb,
-                        self.cc_id(bdb, genid), modelno,
-                        self.cc_colno(bdb, genid, colno), rowid)
-            else:
-                # Obtain likelihood weighted samples from posterior.
-                Q = [(rowid, colno)]
-                Y = [(rowid, c, v) for c,v in zip(colnos, row)
-                     if c != colno and v is not None]
-                samples = self.simulate(bdb, genid, modelno, Q, Y,
-                    numpredictions=numsamples)
-                samples = [s[0] for s in samples]
-        # Predicting fcol.
-        else:
-            conditions = {c:v for c,v in zip(colnames, row) if
-                core.bayesdb_generator_column_number(bdb, genid, c) in
-                self.pcols(bdb, genid, colno)}
-            for colname, val in conditions.iteritems():
-                # Impute all missing parents.
-                if val is None:
-                    imp_col = core.bayesdb_generator_column_number(bdb, genid,
-                        colname)
-                    imp_val, imp_conf = self.predict_confidence(bdb, genid,
-                        modelno, imp_col, rowid, numsamples=numsamples)
+        if colno in compiled.lcols:
+            return [self._predict_local_confidence(bdb, genid, modelno, colno,
+                    rowid, rows[rowid], numsamples)
+                for rowid in rowids]
+        stattype = compiled.stattypes[colno]
+        if stattype not in ('categorical', 'numerical'):
+            raise BLE(ValueError(
+                'Unknown stattype "{}" for a foreign predictor '
+                'column encountered in predict_confidence.'.format(stattype)))
+        # Predicting fcol. Account for multiple imputations if imputing
+        # parents: impute each missing parent for all rows lacking it.
+        parent_conf = np.ones(len(rowids))
+        conditions = {}
+        for pcol in compiled.parents[colno]:
+            values = [rows[rowid][pcol] for rowid in rowids]
+            missing = [k for k, v in enumerate(values) if v is None]
+            if missing:
+                imputed = self._predict_confidence_batch(bdb, genid, modelno,
+                    pcol, [rowids[k] for k in missing], numsamples=numsamples,
+                    rows=rows)
+                for k, (imp_val, imp_conf) in zip(missing, imputed):
                     # XXX If imputing several parents, take the overall
                     # overall conf as min conf. If we define imp_conf as
                     # P[imp_val = correct] then we might choose to multiply
                     # the imp_confs, but we cannot assert that the imp_confs
                     # are independent so multiplying is extremely conservative.
-                    parent_conf = min(parent_conf, imp_conf)
-                    conditions[colname] = imp_val
-            assert all(v is not None for c,v in conditions.iteritems())
-            predictor = self.predictor(bdb, genid, colno)
-            samples = predictor.simulate(numsamples, conditions)
+                    parent_conf[k] = min(parent_conf[k], imp_conf)
+                    values[k] = imp_val
+            conditions[compiled.colnames[pcol]] = np.asarray(values)
         # Since foreign predictor does not know how to impute, imputation
-        # shall occur here in the composer by simulate/logpdf calls.
-        stattype = core.bayesdb_generator_column_stattype(bdb, genid, colno)
+        # shall occur here in the composer by simulate/logpdf calls: all
+        # samples of all rows in one call.
+        predictor = self.predictor(bdb, genid, colno)
+        samples = np.asarray(fp.simulate_many(predictor,
+            {c: np.repeat(v, numsamples) for c, v in conditions.iteritems()}))
+        samples = samples.reshape(len(rowids), numsamples)
         if stattype == 'categorical':
+            # imp_conf is the probability of the most frequent.
+            imp_vals = [_most_frequent(s) for s in samples]
+            imp_confs = np.exp(fp.logpdf_many(predictor, imp_vals, conditions))
+        else:
+            imp_vals = samples.astype(float).mean(axis=1)
+            imp_confs = [self.confidence(s) for s in samples]
+        return [(_python_value(imp_val), imp_conf * conf)
+            for imp_val, imp_conf, conf
+            in zip(imp_vals, imp_confs, parent_conf)]
+
+    def _predict_local_confidence(self, bdb, genid, modelno, colno, rowid, row,
+            numsamples):
+        compiled = self.compiled(bdb, genid)
+        # Delegate to CC IFF
+        # (lcol has no children OR all its children are None).
+        children = [f for f in compiled.fcols if colno in compiled.pcols[f]]
+        if all(row[f] is None for f in children):
+            return compiled.cc.predict_confidence(bdb, compiled.cc_id,
+                modelno, compiled.cc_colnos[colno], rowid)
+        # Obtain likelihood weighted samples from posterior.
+        Q = [(rowid, colno)]
+        Y = [(rowid, c, v) for c, v in row.iteritems()
+             if c != colno and v is not None]
+        samples = [s[0] for s in self.simulate(bdb, genid, modelno, Q, Y,
+            numpredictions=numsamples)]
+        if compiled.stattypes[colno] == 'categorical':
             # imp_conf is most frequent.
-            imp_val =  max(((val, samples.count(val)) for val in set(samples)),
-                key=lambda v: v[1])[0]
-            if colno in self.fcols(bdb, genid):
-                imp_conf = np.exp(predictor.logpdf(imp_val, conditions))
-            else:
-                imp_conf = sum(np.array(samples)==imp_val) / len(samples)
-        elif stattype == 'numerical':
-            # XXX The definition of confidence is P[k=1] where
-            # k=1 is the number of mixture componets (we need a distribution
-            # over GPMM to answer this question). The confidence is instead
-            # implemented as \max_i{p_i} where p_i are the weights of a
-            # fitted DPGMM.
-            imp_val = np.mean(samples)
-            imp_conf = su.continuous_imputation_confidence(samples, None, None,
-                n_steps=1000)
+            imp_val = _most_frequent(samples)
+            imp_conf = samples.count(imp_val) / float(len(samples))
         else:
-            raise BLE(ValueError(
-                'Unknown stattype "{}" for a foreign predictor '
-                'column encountered in predict_confidence.'.format(stattype)))
-        return imp_val, imp_conf * parent_conf
+            imp_val = np.mean(samples)
+            imp_conf = self.confidence(samples)
+        return imp_val, imp_conf
+
+    def _row_values(self, bdb, genid, rowids):
+        # Reads the modelled values of each of `rowids`, as {rowid: {colno:
+        # value}}, in a few queries.
+        compiled = self.compiled(bdb, genid)
+        colnos = sorted(compiled.colnames)
+        sql = 'SELECT _rowid_, {} FROM {} WHERE _rowid_ IN ({})'
+        qcolumns = ','.join(quote(compiled.colnames[c]) for c in colnos)
+        qtable = quote(core.bayesdb_generator_table(bdb, genid))
+        rows = {}
+        for i in xrange(0, len(rowids), ROWS_PER_QUERY):
+            chunk = list(rowids[i:i+ROWS_PER_QUERY])
+            cursor = bdb.sql_execute(sql.format(qcolumns, qtable,
+                ','.join('?' * len(chunk))), chunk)
+            for row in cursor:
+                rows[row[0]] = dict(zip(colnos, row[1:]))
+        missing = [rowid for rowid in rowids if rowid not in rows]
+        if missing:
+            raise BLE(ValueError('No such rows: {}.'.format(missing)))
+        return rows
 
     def simulate_joint(self, bdb, generator_id, targets, constraints, modelno,
             num_predictions=1):
@@ -664,14 +1135,39 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         for r,_ in targets:
             assert r == targets[0][0], "Cannot simulate more than one row, "\
                 "%s and %s requested" % (targets[0][0], r)
-        for _ in xrange(numpredictions):
+        # Without foreign evidence every weight is the same, so forward
+        # sample: each weighted sample is a prediction as it stands.
+        fcols = self.fcols(bdb, genid)
+        if all(c not in fcols for _,c,_ in constraints):
+            samples, _weights = self._weighted_sample(bdb, genid, modelno,
+                targets[0][0], constraints, n_samples=numpredictions)
+            return [[_python_value(samples[col][k]) for col in colnos]
+                for k in xrange(numpredictions)]
+        # Resample all predictions from one weighted pool, taking no more
+        # draws from it than its effective sample size. Should the weights
+        # be too uneven for that to cover every prediction, draw fresh
+        # pools, sized by the ESS of the last one, but never spend more
+        # samples than drawing a pool per prediction would have.
+        budget = numpredictions * self.n_samples
+        pool_size = min(SIR_MAX_POOL, max(self.n_samples, numpredictions))
+        while len(result) < numpredictions:
             samples, weights = self._weighted_sample(bdb, genid, modelno,
-                targets[0][0], constraints)
-            p = np.exp(np.asarray(weights) - np.max(weights))
+                targets[0][0], constraints, n_samples=pool_size)
+            budget -= pool_size
+            p = np.exp(weights - np.max(weights))
             p /= np.sum(p)
-            draw = np.nonzero(bdb.np_prng.multinomial(1,p))[0][0]
-            s = [samples[draw].get(col) for col in colnos]
-            result.append(s)
+            ess = 1. / np.sum(p**2)
+            remaining = numpredictions - len(result)
+            if self.n_samples <= budget:
+                n_draws = min(remaining, max(1, int(ess)))
+            else:
+                n_draws = remaining
+            draws = bdb.np_prng.choice(pool_size, p=p, size=n_draws)
+            result.extend([_python_value(samples[col][draw]) for col in colnos]
+                for draw in draws)
+            remaining -= len(draws)
+            pool_size = int(min(SIR_MAX_POOL, budget, max(self.n_samples,
+                np.ceil(remaining * pool_size / ess))))
         return result
 
     def row_similarity(self, bdb, genid, modelno, rowid, target_rowid,
@@ -682,107 +1178,77 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
             modelno, rowid, target_rowid, cc_colnos)
 
     def _weighted_sample(self, bdb, genid, modelno, row_id, Y, n_samples=None):
-        # Returns a pairs of parallel lists ([sample ...], [weight ...])
-        # Each `sample` is a dict {col:v} of values for all nodes in
-        # the network for one row. Y specifies evidence nodes as (row,
-        # col, value) triples: all returned samples have constrained
-        # values at the evidence nodes.
+        # Returns a pair ({col: [v ...]}, [weight ...]) of weighted
+        # samples, column-major: each column maps to an array of its
+        # values in every sample, for all nodes in the network for one
+        # row. Y specifies evidence nodes as (row, col, value) triples:
+        # all returned samples have constrained values at the evidence
+        # nodes.
         # `weight` is the likelihood of the evidence Y under s\Y.
         if n_samples is None:
             n_samples = self.n_samples
-        # Create n_samples dicts, each entry is weighted sample from joint.
-        samples = [{c:v for r,c,v in Y if r == row_id}
-                   for _ in xrange(n_samples)]
-        weights = []
-        w0 = 0
+        compiled = self.compiled(bdb, genid)
+        evidence = {c:v for r,c,v in Y if r == row_id}
+        samples = {c:np.asarray([v] * n_samples)
+                   for c,v in evidence.iteritems()}
+        weights = np.zeros(n_samples)
         # Assess likelihood of evidence at root.
-        Y_cc = [(r, c, v) for r,c,v in Y if c in self.lcols(bdb, genid)]
+        Y_cc = [(r, c, v) for r,c,v in Y if c in compiled.lcols]
         if Y_cc:
-            w0 += self.cc(bdb, genid).logpdf_joint(bdb, self.cc_id(bdb, genid),
-                Y_cc, [], modelno)
-        # Simulate unobserved ccs.
-        Q_cc = [(row_id, c)
-                for c in self.lcols(bdb, genid) if c not in samples[0]]
-        V_cc = self.cc(bdb, genid).simulate_joint(bdb, self.cc_id(bdb, genid),
-            Q_cc, Y_cc, modelno, num_predictions=n_samples)
-        for k in xrange(n_samples):
-            w = w0
-            # Add simulated Q_cc.
-            samples[k].update({c:v for (_, c), v in zip(Q_cc, V_cc[k])})
-            for fcol in self.topo(bdb, genid):
-                pcols = self.pcols(bdb, genid, fcol)
-                predictor = self.predictor(bdb, genid, fcol)
-                # All parents of FP known (evidence or simulated)?
-                assert pcols.issubset(set(samples[k]))
-                conditions = {core.bayesdb_generator_column_name(
-                    bdb, genid, c):v for c,v in samples[k].iteritems()
-                        if c in pcols}
-                if fcol in samples[k]:
-                    # f is evidence: compute likelihood weight.
-                    w += predictor.logpdf(samples[k][fcol], conditions)
-                else:
-                    # f is latent: simulate from conditional distribution.
-                    samples[k][fcol] = predictor.simulate(1, conditions)[0]
-            weights.append(w)
+            weights += self._memoize_evidence(bdb, genid,
+                ('logpdf_cc', modelno, tuple(sorted(Y_cc))),
+                lambda: compiled.cc.logpdf_joint(bdb, compiled.cc_id, Y_cc,
+                    [], modelno))
+        # Simulate unobserved ccs, all samples at once.
+        Q_cc = [(row_id, c) for c in compiled.lcols if c not in evidence]
+        V_cc = compiled.cc.simulate_joint(bdb, compiled.cc_id, Q_cc, Y_cc,
+            modelno, num_predictions=n_samples)
+        for i, (_, c) in enumerate(Q_cc):
+            samples[c] = np.asarray([v[i] for v in V_cc])
+        # Push every sample through each FP in topological order.
+        for fcol in compiled.topo:
+            predictor = self.predictor(bdb, genid, fcol)
+            # All parents of FP known (evidence or simulated)?
+            assert compiled.pcols[fcol].issubset(samples)
+            conditions = {compiled.colnames[c]: samples[c]
+                for c in compiled.parents[fcol]}
+            if fcol in evidence:
+                # f is evidence: compute likelihood weight.
+                weights += fp.logpdf_many(predictor, samples[fcol],
+                    conditions)
+            else:
+                # f is latent: simulate from conditional distribution.
+                samples[fcol] = np.asarray(fp.simulate_many(predictor,
+                    conditions))
         return samples, weights
 
     def cc_colno(self, bdb, genid, colno):
         return self.cc_colnos(bdb, genid, [colno])[0]
 
     def cc_colnos(self, bdb, genid, colnos):
-        lcolnames = [bayeslite.core.bayesdb_generator_column_name(bdb,
-            genid, colno) for colno in colnos]
-        return [bayeslite.core.bayesdb_generator_column_number(bdb,
-            self.cc_id(bdb, genid), lcolname) for lcolname in lcolnames]
+        cc_colnos = self.compiled(bdb, genid).cc_colnos
+        return [cc_colnos[colno] for colno in colnos]
 
     def cc_id(self, bdb, genid):
-        cursor = bdb.sql_execute('''
-            SELECT crosscat_generator_id FROM bayesdb_composer_cc_id
-                WHERE generator_id = ?
-        ''', (genid,))
-        return cursor.fetchall()[0][0]
+        return self.compiled(bdb, genid).cc_id
 
     def cc(self, bdb, genid):
-        return core.bayesdb_generator_metamodel(bdb, self.cc_id(bdb, genid))
+        return self.compiled(bdb, genid).cc
 
     def lcols(self, bdb, genid):
-        cursor = bdb.sql_execute('''
-            SELECT colno FROM bayesdb_composer_column_owner
-                WHERE generator_id = ? AND local = 1
-                ORDER BY colno ASC
-        ''', (genid,))
-        return set([row[0] for row in cursor])
+        return self.compiled(bdb, genid).lcols
 
     def fcols(self, bdb, genid):
-        cursor = bdb.sql_execute('''
-            SELECT colno FROM bayesdb_composer_column_owner
-                WHERE generator_id = ? AND local = 0
-                ORDER BY colno ASC
-        ''', (genid,))
-        return set([row[0] for row in cursor])
+        return self.compiled(bdb, genid).fcols
 
     def pcols(self, bdb, genid, fcolno):
-        cursor = bdb.sql_execute('''
-            SELECT pcolno FROM bayesdb_composer_column_parents
-                WHERE generator_id = ? AND fcolno = ?
-                ORDER BY pcolno ASC
-        ''', (genid, fcolno))
-        return set([row[0] for row in cursor])
+        return self.compiled(bdb, genid).pcols.get(fcolno, set())
 
     def topo(self, bdb, genid):
-        cursor = bdb.sql_execute('''
-            SELECT colno FROM bayesdb_composer_column_toposort
-                WHERE generator_id = ?
-                ORDER BY position ASC
-            ''', (genid,))
-        return [row[0] for row in cursor]
+        return self.compiled(bdb, genid).topo
 
     def predictor_name(self, bdb, genid, fcol):
-        cursor = bdb.sql_execute('''
-            SELECT predictor_name FROM bayesdb_composer_column_foreign_predictor
-                WHERE generator_id = ? AND colno = ?
-        ''', (genid, fcol))
-        return cursor.fetchall()[0][0]
+        return self.compiled(bdb, genid).predictor_names[fcol]
 
     def predictor(self, bdb, genid, fcol):
         if (genid, fcol) not in self._predictor_cache(bdb):
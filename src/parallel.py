@@ -27,11 +27,15 @@ become intractable.  Splitting the processing up among multiple cores can
 greatly reduce computation time; this module provides functionality to assist
 this multiprocessing.
 
-Currently, a multiprocessing equivalent is provided only for
+Currently, a multiprocessing equivalent is provided for
 ``ESTIMATE PAIRWISE SIMILARITY``. In fact, this is a query that is most likely
 to require multiprocessing, as datasets frequently have many more rows than
 columns.
 
+``ANALYZE`` can also be split among processes by model, with
+``analyze_models``: each worker analyzes a disjoint range of models in its own
+copy of the bdb, and the results are merged back into the original.
+
 Example
 -------
 
@@ -76,8 +80,24 @@ machines.
 from bayeslite.exception import BayesLiteException as BLE
 from bdbcontrib.bql_utils import cursor_to_df
 import multiprocessing as mp
+import os
+import random
+import shutil
+import struct
+import tempfile
+
+import apsw
+
+import bayeslite
+import bayeslite.core
 from bayeslite import bayesdb_open, bql_quote_name
+from bayeslite.metamodels.crosscat import CrosscatMetamodel
 from bayeslite.util import cursor_value
+from crosscat.LocalEngine import LocalEngine as CrosscatLocalEngine
+
+from bdbcontrib.bql_utils import modelset_bql
+from bdbcontrib.diagnostic_utils import diagnostics_generator_id
+from bdbcontrib.storage_utils import backup_bdb
 
 
 def _query_into_queue(query_string, params, queue, bdb_file):
@@ -231,19 +251,325 @@ def estimate_pairwise_similarity(bdb_file, table, model, sim_table=None,
         ESTIMATE SIMILARITY FROM PAIRWISE {} LIMIT ? OFFSET ?
     ''' .format(bql_quote_name(model))
 
-    for so in zip(sizes, offsets):
-        pool.apply_async(
-            _query_into_queue, args=(q_template, so, queue, bdb_file)
-        )
+    jobs = [pool.apply_async(
+                _query_into_queue, args=(q_template, so, queue, bdb_file))
+            for so in zip(sizes, offsets)]
 
     # Close pool and wait for processes to finish
     # FIXME: This waits for all processes to finish before inserting
     # into the table, which means that memory usage is potentially very
     # high!
     pool.close()
-    pool.join()
+    try:
+        # Reraise any exception of a worker here, rather than lose it.
+        for job in jobs:
+            job.get()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
     # Process returned results
     while not queue.empty():
         df = queue.get()
         insert_into_sim(df)
+
+    count = cursor_value(bdb.sql_execute(
+        'SELECT COUNT(*) FROM {}'.format(sim_table_q)))
+    if count != N * N:
+        raise BLE(RuntimeError(
+            "Expected {} similarities in {} but found {}".format(
+                N * N, sim_table, count)))
+
+
+def query_pairwise_similarity(bdb, generator, cores=None):
+    """
+    Return ``ESTIMATE SIMILARITY FROM PAIRWISE generator`` as a DataFrame,
+    estimated by estimate_pairwise_similarity in worker processes.
+
+    Parameters
+    ----------
+    bdb : bayeslite.BayesDB
+        A BayesDB stored in a file, which the workers open on their own.
+        Its changes must be committed for the workers to see them.
+    generator : str
+        Name of the generator to estimate from.
+    cores : int
+        Number of processors to use. Defaults to all of them.
+    """
+    generator_id = bayeslite.core.bayesdb_get_generator(bdb, generator)
+    table = bayeslite.core.bayesdb_generator_table(bdb, generator_id)
+    sim_table = bdb.temp_table_name()
+    estimate_pairwise_similarity(bdb.pathname, table, generator,
+                                 sim_table=sim_table, cores=cores)
+    try:
+        return cursor_to_df(bdb.execute(
+            'SELECT rowid0, rowid1, value FROM %s ORDER BY rowid0, rowid1'
+            % (bql_quote_name(sim_table),)))
+    finally:
+        bdb.sql_execute('DROP TABLE IF EXISTS %s'
+                        % (bql_quote_name(sim_table),))
+
+
+def _analyze_models_in_copy(bdb_file, generator, modelnos, duration, seed):
+    """
+    Analyze `modelnos` of `generator` in the bdb at `bdb_file`.
+
+    Like _query_into_queue, this is a toplevel function that opens its own
+    bdb handle, so that it can run in a multiprocessing worker. The crosscat
+    engine and the bdb's own PRNG are both seeded from `seed`, so that the
+    analysis is reproducible.
+
+    Parameters
+    ----------
+    bdb_file : str
+        File location of a private copy of the BayesDB database.
+    generator : str
+        Name of the crosscat generator to analyze.
+    modelnos : list<int>
+        Models to analyze.
+    duration : str
+        The FOR ... [CHECKPOINT ...] clause of the ANALYZE query.
+    seed : int
+        Entropy for this worker.
+    """
+    bdb = bayesdb_open(pathname=bdb_file, builtin_metamodels=False,
+                       seed=struct.pack('<QQQQ', 0, 0, 0, seed))
+    try:
+        bayeslite.bayesdb_register_metamodel(bdb,
+            CrosscatMetamodel(CrosscatLocalEngine(seed=seed)))
+        bdb.execute('ANALYZE %s MODELS %s %s WAIT' % (
+            bql_quote_name(generator), modelset_bql(modelnos), duration))
+    finally:
+        bdb.close()
+
+
+def _read_analysis(bdb_file, generator_id, modelnos):
+    """Read back what _analyze_models_in_copy wrote for `modelnos`."""
+    qmodelnos = ','.join('%d' % (modelno,) for modelno in modelnos)
+    connection = apsw.Connection(bdb_file)
+    try:
+        cursor = connection.cursor()
+        thetas = list(cursor.execute('''
+            SELECT modelno, theta_json FROM bayesdb_crosscat_theta
+                WHERE generator_id = ? AND modelno IN (%s)
+        ''' % (qmodelnos,), (generator_id,)))
+        iterations = list(cursor.execute('''
+            SELECT modelno, iterations FROM bayesdb_generator_model
+                WHERE generator_id = ? AND modelno IN (%s)
+        ''' % (qmodelnos,), (generator_id,)))
+        diagnostics = list(cursor.execute('''
+            SELECT * FROM bayesdb_crosscat_diagnostics
+                WHERE generator_id = ? AND modelno IN (%s)
+        ''' % (qmodelnos,), (generator_id,)))
+    finally:
+        connection.close()
+    return thetas, iterations, diagnostics
+
+
+def analyze_models(bdb, generator, modelnos=None, iterations=0, minutes=0,
+                   checkpoint=None, processes=None, seed=0):
+    """
+    Analyze the models of `generator`, splitting them across processes, and
+    merge the results back into `bdb`.
+
+    Each of `processes` workers analyzes a disjoint, contiguous range of the
+    models in its own copy of `bdb`. When all have finished, the models'
+    thetas, diagnostics, and iteration counts are copied back into `bdb` in
+    a single transaction, so either every worker's results are merged or
+    none are.
+
+    For a given `seed` and number of processes, the results are
+    deterministic.
+
+    Parameters
+    ----------
+    bdb : bayeslite.BayesDB
+        The BayesDB to analyze. It may be in memory.
+    generator : str
+        Name of a crosscat or composer generator. For a composer generator,
+        its internal crosscat generator is analyzed.
+    modelnos : list<int>, optional
+        Models to analyze. Defaults to all models of the generator.
+    iterations : int
+        How many iterations to analyze each model for.
+    minutes : int
+        How many minutes to analyze for, if `iterations` is zero.
+    checkpoint : int, optional
+        Number of iterations between checkpoints.
+    processes : int, optional
+        Number of worker processes. Defaults to the number of cores as
+        identified by multiprocessing.cpu_count.
+    seed : int
+        Initial entropy for the workers' crosscat engines. Default: 0.
+    """
+    if processes is None:
+        processes = mp.cpu_count()
+    if processes < 1:
+        raise BLE(ValueError(
+            "Invalid number of processes {}".format(processes)))
+    duration = _analysis_duration(iterations, minutes, checkpoint)
+
+    generator_id = bayeslite.core.bayesdb_get_generator(bdb, generator)
+    cc_generator_id = diagnostics_generator_id(bdb, generator)
+    cc_generator = bayeslite.core.bayesdb_generator_name(bdb, cc_generator_id)
+    if modelnos is None:
+        modelnos = bayeslite.core.bayesdb_generator_modelnos(bdb, generator_id)
+    modelnos = sorted(modelnos)
+    if not modelnos:
+        return
+    processes = min(processes, len(modelnos))
+    size = (len(modelnos) + processes - 1) // processes
+    ranges = list(_chunks(modelnos, size))
+    prng = random.Random(seed)
+    tasks = [(generator_id, cc_generator_id, cc_generator, models,
+              prng.randint(0, 2**31 - 1))
+             for models in ranges]
+    _run_analysis_tasks(bdb, tasks, duration, processes)
+
+
+def analyze_generators(bdb, generators, iterations=0, minutes=0,
+                       checkpoint=None, processes=None, seed=0):
+    """
+    Analyze all the models of several generators concurrently, each in its
+    own worker process, and merge the results back into `bdb`.
+
+    With `minutes`, the whole takes about `minutes` of wall-clock time
+    however many generators there are. With a process per generator,
+    every generator is analyzed that long at the same time. With fewer
+    processes, the generators are analyzed in rounds, and each round gets
+    an equal share of the time. Otherwise as analyze_models.
+
+    Parameters
+    ----------
+    bdb : bayeslite.BayesDB
+        The BayesDB to analyze. It may be in memory.
+    generators : list<str>
+        Names of crosscat or composer generators, no two of which share a
+        crosscat generator.
+    iterations : int
+        How many iterations to analyze each model for.
+    minutes : int
+        How many minutes to analyze for, if `iterations` is zero.
+    checkpoint : int, optional
+        Number of iterations between checkpoints.
+    processes : int, optional
+        Number of worker processes. Defaults to one per generator.
+    seed : int
+        Initial entropy for the workers' crosscat engines. Default: 0.
+    """
+    _analysis_duration(iterations, minutes, checkpoint)
+    prng = random.Random(seed)
+    tasks = []
+    for generator in generators:
+        generator_id = bayeslite.core.bayesdb_get_generator(bdb, generator)
+        cc_generator_id = diagnostics_generator_id(bdb, generator)
+        if cc_generator_id in [task[1] for task in tasks]:
+            raise BLE(ValueError('Generator %s shares its crosscat models '
+                                 'with another of %r.' % (generator,
+                                                          generators)))
+        cc_generator = bayeslite.core.bayesdb_generator_name(
+            bdb, cc_generator_id)
+        modelnos = sorted(bayeslite.core.bayesdb_generator_modelnos(
+            bdb, generator_id))
+        worker_seed = prng.randint(0, 2**31 - 1)
+        if modelnos:
+            tasks.append((generator_id, cc_generator_id, cc_generator,
+                          modelnos, worker_seed))
+    if not tasks:
+        return
+    if processes is None:
+        processes = len(tasks)
+    if processes < 1:
+        raise BLE(ValueError(
+            "Invalid number of processes {}".format(processes)))
+    processes = min(processes, len(tasks))
+    # Tasks beyond the first `processes` wait for a free worker, so a time
+    # budget is split among the rounds of tasks.
+    rounds = (len(tasks) + processes - 1) // processes
+    duration = _analysis_duration(iterations, minutes, checkpoint,
+                                  rounds=rounds)
+    _run_analysis_tasks(bdb, tasks, duration, processes)
+
+
+def _analysis_duration(iterations, minutes, checkpoint, rounds=1):
+    """Return the FOR ... [CHECKPOINT ...] clause of an ANALYZE query, for
+    one of `rounds` analyses sharing a time budget of `minutes`."""
+    if iterations > 0:
+        duration = 'FOR %d ITERATIONS' % (iterations,)
+    elif minutes > 0 and rounds == 1:
+        duration = 'FOR %d MINUTES' % (minutes,)
+    elif minutes > 0:
+        duration = 'FOR %d SECONDS' % (max(1, 60 * minutes // rounds),)
+    else:
+        raise BLE(ValueError('Please specify minutes or iterations.'))
+    if checkpoint:
+        duration += ' CHECKPOINT %d ITERATION' % (checkpoint,)
+    return duration
+
+
+def _run_analysis_tasks(bdb, tasks, duration, processes):
+    """
+    Run each task, a tuple (generator_id, cc_generator_id, cc_generator,
+    modelnos, seed), in its own copy of `bdb` in a pool of `processes`
+    workers, then merge all the results into `bdb` in one transaction.
+    """
+    tempdir = tempfile.mkdtemp(prefix='bdbcontrib-analyze-')
+    try:
+        copies = [os.path.join(tempdir, '%d.bdb' % (i,))
+                  for i in xrange(len(tasks))]
+        for copy in copies:
+            backup_bdb(bdb, copy)
+        pool = mp.Pool(processes=processes)
+        try:
+            jobs = [pool.apply_async(_analyze_models_in_copy,
+                                     args=(copy, cc_generator, models,
+                                           duration, worker_seed))
+                    for copy, (_, _, cc_generator, models, worker_seed)
+                    in zip(copies, tasks)]
+            pool.close()
+            # Reraise any worker's exception before merging anything.
+            for job in jobs:
+                job.get()
+        finally:
+            pool.terminate()
+            pool.join()
+        results = [_read_analysis(copy, cc_generator_id, models)
+                   for copy, (_, cc_generator_id, _, models, _)
+                   in zip(copies, tasks)]
+    finally:
+        shutil.rmtree(tempdir)
+
+    with bdb.savepoint():
+        for (generator_id, cc_generator_id, _, models, _), \
+                (thetas, cc_iterations, diagnostics) in zip(tasks, results):
+            for modelno, theta_json in thetas:
+                bdb.sql_execute('''
+                    UPDATE bayesdb_crosscat_theta SET theta_json = ?
+                        WHERE generator_id = ? AND modelno = ?
+                ''', (theta_json, cc_generator_id, modelno))
+            for modelno, its in cc_iterations:
+                if cc_generator_id != generator_id:
+                    # Composer accounting, as in Composer.analyze_models.
+                    bdb.sql_execute('''
+                        UPDATE bayesdb_generator_model
+                            SET iterations = iterations + ? - (
+                                SELECT iterations FROM bayesdb_generator_model
+                                    WHERE generator_id = ? AND modelno = ?)
+                            WHERE generator_id = ? AND modelno = ?
+                    ''', (its, cc_generator_id, modelno, generator_id,
+                          modelno))
+                bdb.sql_execute('''
+                    UPDATE bayesdb_generator_model SET iterations = ?
+                        WHERE generator_id = ? AND modelno = ?
+                ''', (its, cc_generator_id, modelno))
+            bdb.sql_execute('''
+                DELETE FROM bayesdb_crosscat_diagnostics
+                    WHERE generator_id = ? AND modelno IN (%s)
+            ''' % (','.join('%d' % (modelno,) for modelno in models),),
+                (cc_generator_id,))
+            for row in diagnostics:
+                bdb.sql_execute('''
+                    INSERT INTO bayesdb_crosscat_diagnostics VALUES (%s)
+                ''' % (','.join('?' * len(row)),), row)
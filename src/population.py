@@ -16,10 +16,12 @@
 
 # pylint: disable=no-member
 
+import copy
 import os
 import pandas as pd
 import re
 import sys
+import time
 
 import bayeslite
 import bayeslite.core
@@ -56,13 +58,17 @@ class Population(object):
     import recipes
     import diagnostic_utils
     import crosscat_utils
+    import fingerprint
+    import connection_pool
+    import cost_model
     # Convenience alias:
     cls.q = cls.query
     cls.vartype = cls.get_column_stattype
     cls.quick_describe_columns = cls.variable_stattypes
 
   def __init__(self, name, csv_path=None, bdb_path=None, df=None, logger=None,
-               session_capture_name=None):
+               session_capture_name=None, snapshot_path=None,
+               snapshot_checkpoints=1, snapshot_seconds=0):
     """Create a Population object, wrapping a bayeslite.BayesDB.
 
     name : str  REQUIRED.
@@ -85,6 +91,16 @@ class Population(object):
         user. By default a bayeslite.loggers.BqlLogger, but could be QuietLogger
         (only results), SilentLogger (nothing), IpyLogger, CaptureLogger,
         LoggingLogger, or anything else that implements the BqlLogger interface.
+    snapshot_path : str
+        With no bdb_path, keep the bdb in memory for speed, but copy it to
+        this file as analysis proceeds, and restore it from this file, if
+        it exists, when starting up.
+    snapshot_checkpoints : int
+        With snapshot_path, copy the bdb after this many analysis
+        checkpoints, and at the end of each analysis.
+    snapshot_seconds : float
+        With snapshot_path, also copy the bdb at the first checkpoint at
+        least this long after the last copy.
     session_capture_name : String
         Signing up with your name and email and sending your session details
         to the MIT Probabilistic Computing Group helps build a community of
@@ -107,7 +123,10 @@ class Population(object):
     """
     Population.method_imports()
     assert re.match(r'\w+', name)
-    assert df is not None or csv_path or bdb_path
+    assert df is not None or csv_path or bdb_path or snapshot_path
+    if bdb_path is not None and snapshot_path is not None:
+      raise BLE(ValueError('Snapshots are for in-memory populations; this'
+                           ' one is already stored in %s.' % (bdb_path,)))
     self.name = name
     self.generator_name = name + '_cc' # Because we use the default metamodel.
     self.csv_path = csv_path
@@ -123,8 +142,14 @@ class Population(object):
       self.logger = logger
     self.bdb = None
     self.status = None
+    self.convergence = None
     self.session_capture_name = None
     self.generators = []
+    self.snapshot_path = snapshot_path
+    self.snapshot_checkpoints = snapshot_checkpoints
+    self.snapshot_seconds = snapshot_seconds
+    self.checkpoints_since_snapshot = 0
+    self.last_snapshot_time = time.time()
     with logged_query('count-beacon', None, name='count-beacon'):
       self.initialize_session_capture(session_capture_name)
     self.initialize()
@@ -162,6 +187,9 @@ class Population(object):
       self.check_representation()
       return
     self.bdb = bayeslite.bayesdb_open(self.bdb_path)
+    if self.snapshot_path is not None and os.path.exists(self.snapshot_path):
+      from bdbcontrib.storage_utils import restore_bdb
+      restore_bdb(self.bdb, self.snapshot_path)
     if not bayeslite.core.bayesdb_has_table(self.bdb, self.name):
       if self.df is not None:
         bayeslite.read_pandas.bayesdb_read_pandas_df(
@@ -215,9 +243,109 @@ class Population(object):
     self.check_representation()
     self.query('drop generator if exists %s' % self.generator_name)
     self.query('drop table if exists %s' % self.name)
+    if self.snapshot_path is not None and os.path.exists(self.snapshot_path):
+      os.remove(self.snapshot_path)
     self.bdb = None
     self.initialize()
 
+  def snapshot(self):
+    """Copy the bdb to snapshot_path, replacing the last copy atomically."""
+    self.check_representation()
+    from bdbcontrib.storage_utils import backup_bdb
+    temporary = self.snapshot_path + '.tmp'
+    backup_bdb(self.bdb, temporary)
+    os.rename(temporary, self.snapshot_path)
+    self.checkpoints_since_snapshot = 0
+    self.last_snapshot_time = time.time()
+
+  def checkpointed(self):
+    """Note an analysis checkpoint, and snapshot if the policy says to."""
+    if self.snapshot_path is None:
+      return
+    self.checkpoints_since_snapshot += 1
+    if ((0 < self.snapshot_checkpoints <= self.checkpoints_since_snapshot) or
+        (0 < self.snapshot_seconds <=
+         time.time() - self.last_snapshot_time)):
+      self.snapshot()
+
+  def fork(self, path=None, models=None):
+    """Return a copy of this population, to experiment on independently.
+
+    The copy, made in one pass with SQLite's online backup, starts with
+    this population's data and analysis.
+
+    path : str
+        Where to store the copy's bdb. If not specified, in memory.
+    models : list of int
+        If specified, the copy keeps only these models of the population's
+        generator.
+    """
+    self.check_representation()
+    from bdbcontrib.bql_utils import modelset_bql
+    from bdbcontrib.storage_utils import copy_bdb
+    bdb = bayeslite.bayesdb_open(path)
+    copy_bdb(self.bdb, bdb)
+    for name, metamodel in self.bdb.metamodels.iteritems():
+      if name not in bdb.metamodels:
+        bayeslite.bayesdb_register_metamodel(bdb, metamodel)
+    if models is not None:
+      generator_id = bayeslite.core.bayesdb_get_generator(
+        bdb, self.generator_name)
+      unwanted = set(bayeslite.core.bayesdb_generator_modelnos(
+        bdb, generator_id)) - set(models)
+      if unwanted:
+        bdb.execute('DROP MODELS %s FROM %s' % (
+          modelset_bql(unwanted), bayeslite.bql_quote_name(self.generator_name)))
+    forked = copy.copy(self)
+    # Nothing mutable may be shared, or changes to one would show in both.
+    forked.df = copy.deepcopy(self.df)
+    forked.generators = copy.deepcopy(self.generators)
+    forked.bdb = bdb
+    forked.bdb_path = path
+    forked.status = None
+    forked.convergence = None
+    forked.snapshot_path = None
+    return forked
+
+  def export_snapshot(self, pathname):
+    """Write the population's data and models to a compact bdb file.
+
+    Open it again, e.g. in a serving process, with
+    Population.from_snapshot(pathname).
+    """
+    self.check_representation()
+    from bdbcontrib.fingerprint import table_fingerprint
+    from bdbcontrib.storage_utils import export_snapshot
+    fingerprint = table_fingerprint(self.bdb, self.name)
+    export_snapshot(self.bdb, pathname, {
+      'name': self.name,
+      'generator_name': self.generator_name,
+      'rows': fingerprint['rows'],
+      'content': fingerprint['content'],
+      'created': time.time(),
+    })
+
+  @classmethod
+  def from_snapshot(cls, pathname, logger=None, session_capture_name=None):
+    """Open a population from a file written by export_snapshot.
+
+    The file is memory-mapped, so processes serving from the same snapshot
+    share its pages, and opened read-only, so that none of them can change
+    it under the others: fork the population to analyze it further. This
+    saves copying the bdb, not decoding its models: queries still parse
+    crosscat's theta JSON and unpickle foreign predictors, once per
+    transaction, as from any bdb.
+    """
+    from bdbcontrib.storage_utils import SNAPSHOT_MMAP_SIZE
+    from bdbcontrib.storage_utils import read_snapshot_manifest
+    manifest = read_snapshot_manifest(pathname)
+    population = cls(name=manifest['name'], bdb_path=pathname, logger=logger,
+                     session_capture_name=session_capture_name)
+    population.generator_name = manifest['generator_name']
+    population.bdb.sql_execute('PRAGMA mmap_size = %d' % (SNAPSHOT_MMAP_SIZE,))
+    population.bdb.sql_execute('PRAGMA query_only = ON')
+    return population
+
   def specifier_to_df(self, spec):
     if isinstance(spec, pd.DataFrame):
       return spec
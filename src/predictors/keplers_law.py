@@ -122,6 +122,28 @@ class KeplersLaw(predictor.IBayesDBForeignPredictor):
         period_minutes = satellite_period_minutes(apogee_km, perigee_km)
         return logpdfGaussian(value, period_minutes, self.noise)
 
+    def simulate_many(self, conditions):
+        apogee_km, perigee_km = self._conditions_many(conditions)
+        period_minutes = satellite_period_minutes(apogee_km, perigee_km)
+        return period_minutes + self.prng.normal(scale=self.noise,
+            size=len(period_minutes))
+
+    def logpdf_many(self, values, conditions):
+        apogee_km, perigee_km = self._conditions_many(conditions)
+        period_minutes = satellite_period_minutes(apogee_km, perigee_km)
+        return logpdfGaussian(np.asarray(values, dtype=float), period_minutes,
+            self.noise)
+
+    def _conditions_many(self, conditions):
+        if not set(self.conditions).issubset(set(conditions.keys())):
+            raise BLE(ValueError(
+                'Must specify values for all the conditionals.\n'
+                'Received: {}\n'
+                'Expected: {}'.format(conditions.keys(), self.conditions)))
+        apogee_km, perigee_km = self._conditions(conditions)
+        return (np.asarray(apogee_km, dtype=float),
+            np.asarray(perigee_km, dtype=float))
+
 HALF_LOG2PI = 0.5 * math.log(2 * math.pi)
 def logpdfGaussian(x, mu, sigma):
     deviation = x - mu
@@ -212,8 +212,52 @@ class MultipleRegression(predictor.IBayesDBForeignPredictor):
         prediction, noise = self._compute_targets_distribution(conditions)
         return logpdfGaussian(value, prediction, noise)
 
+    def simulate_many(self, conditions):
+        predictions, noise = self._compute_targets_distributions(conditions)
+        return predictions + noise * self.prng.normal(size=len(predictions))
+
+    def logpdf_many(self, values, conditions):
+        predictions, noise = self._compute_targets_distributions(conditions)
+        return logpdfGaussian(np.asarray(values, dtype=float), predictions,
+            noise)
+
+    def _compute_targets_distributions(self, conditions):
+        """Given conditions dict {feature_col:array}, returns arrays of the
+        conditional means of the `targets`, and the scales of the noise.
+        """
+        if not set(self.conditions).issubset(set(conditions.keys())):
+            raise BLE(ValueError(
+                'Must specify values for all the conditionals.\n'
+                'Received: {}\n'
+                'Expected: {}'.format(conditions.keys(),
+                    self.conditions_numerical + self.conditions_categorical)))
+        n_samples = len(conditions[self.conditions[0]])
+        # Samples with category values unseen in training use the partial
+        # regression.
+        unseen = np.array([any(conditions[cat][k] not in
+                self.categories_to_val_map[cat]
+                for cat in self.conditions_categorical)
+            for k in xrange(n_samples)], dtype=bool)
+        X_numerical = np.array([np.asarray(conditions[col], dtype=float)
+            for col in self.conditions_numerical]).T.reshape(n_samples, -1)
+        predictions = np.zeros(n_samples)
+        noise = np.zeros(n_samples)
+        if unseen.any():
+            predictions[unseen] = self.mr_partial.predict(X_numerical[unseen])
+            noise[unseen] = self.mr_partial_noise
+        seen = ~unseen
+        if seen.any():
+            X_categorical = np.array([utils.binarize_categorical_row(
+                    self.conditions_categorical, self.categories_to_val_map,
+                    [conditions[col][k] for col in self.conditions_categorical])
+                for k in np.flatnonzero(seen)]).reshape(seen.sum(), -1)
+            predictions[seen] = self.mr_full.predict(
+                np.hstack((X_numerical[seen], X_categorical)))
+            noise[seen] = self.mr_full_noise
+        return predictions, noise
+
 HALF_LOG2PI = 0.5 * math.log(2 * math.pi)
 def logpdfGaussian(x, mu, sigma):
     deviation = x - mu
-    return - math.log(sigma) - HALF_LOG2PI \
+    return - np.log(sigma) - HALF_LOG2PI \
         - (0.5 * deviation * deviation / (sigma * sigma))
@@ -14,6 +14,8 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import numpy as np
+
 class IBayesDBForeignPredictorFactory(object):
     """PRELIMINARY BayesDB foreign predictor factory interface.
 
@@ -174,3 +176,77 @@ class IBayesDBForeignPredictor(object):
             given the conditions.
         """
         raise NotImplementedError
+
+    def simulate_many(self, conditions):
+        """Simulate one value of `target` for each of many `conditions`.
+
+        Parameters
+        ----------
+        conditions : dict
+            A dictionary of {'condition':array} giving, for all
+            `conditions` required by the FP, an array of values, one
+            per sample.  All arrays have the same length.
+
+        Returns
+        -------
+        numpy.ndarray
+            One simulated value for each sample.
+
+        The default calls :meth:`simulate` once per sample; FPs which
+        can do better should override it.
+        """
+        return simulate_each(self, conditions)
+
+    def logpdf_many(self, values, conditions):
+        """Evaluate the log-density of each of many `values`.
+
+        Parameters
+        ----------
+        values : array
+            The values of `target` to query, one per sample.
+
+        conditions : dict
+            As for :meth:`simulate_many`.
+
+        Returns
+        -------
+        numpy.ndarray
+            The log density of each value given its conditions.
+
+        The default calls :meth:`logpdf` once per sample; FPs which
+        can do better should override it.
+        """
+        return logpdf_each(self, values, conditions)
+
+def simulate_many(predictor, conditions):
+    """Call `predictor.simulate_many`, or :func:`simulate_each` if it has none.
+
+    Foreign predictors need not derive from
+    :class:`IBayesDBForeignPredictor`, so may lack the batch methods.
+    """
+    if hasattr(predictor, 'simulate_many'):
+        return predictor.simulate_many(conditions)
+    return simulate_each(predictor, conditions)
+
+def logpdf_many(predictor, values, conditions):
+    """Call `predictor.logpdf_many`, or :func:`logpdf_each` if it has none."""
+    if hasattr(predictor, 'logpdf_many'):
+        return predictor.logpdf_many(values, conditions)
+    return logpdf_each(predictor, values, conditions)
+
+def each_condition(conditions, n_samples):
+    """Split a dict of condition arrays into one dict per sample."""
+    return [{c: v[k] for c, v in conditions.iteritems()}
+            for k in xrange(n_samples)]
+
+def simulate_each(predictor, conditions):
+    """Batch simulation by one call to `predictor.simulate` per sample."""
+    n_samples = len(conditions.itervalues().next())
+    return np.asarray([predictor.simulate(1, c)[0]
+                       for c in each_condition(conditions, n_samples)])
+
+def logpdf_each(predictor, values, conditions):
+    """Batch logpdf by one call to `predictor.logpdf` per sample."""
+    return np.asarray([predictor.logpdf(v, c) for v, c
+                       in zip(values, each_condition(conditions, len(values)))],
+                      dtype=float)
@@ -188,3 +188,56 @@ class RandomForest(predictor.IBayesDBForeignPredictor):
         if value not in classes:
             return -float('inf')
         return np.log(distribution[np.where(classes==value)[0][0]])
+
+    def simulate_many(self, conditions):
+        distributions, classes = self._compute_targets_distributions(
+            conditions)
+        # Inverse-cdf draw of one class per sample.
+        u = self.prng.uniform(size=len(distributions))
+        cdf = np.cumsum(distributions, axis=1)
+        draws = np.minimum(np.sum(cdf < u[:,np.newaxis], axis=1),
+            len(classes) - 1)
+        return classes[draws]
+
+    def logpdf_many(self, values, conditions):
+        distributions, classes = self._compute_targets_distributions(
+            conditions)
+        index = {c: i for i, c in enumerate(classes)}
+        with np.errstate(divide='ignore'):
+            return np.array([np.log(distribution[index[value]])
+                if value in index else -float('inf')
+                for distribution, value in zip(distributions, values)])
+
+    def _compute_targets_distributions(self, conditions):
+        """Given conditions dict {feature_col:array}, returns the
+        distributions of the random label self.targets|conditions, one row
+        per sample, and the class mapping for lookup.
+        """
+        if not set(self.conditions).issubset(set(conditions.keys())):
+            raise BLE(ValueError(
+                'Must specify values for all the conditionals.\n'
+                'Received: {}\n'
+                'Expected: {}'.format(conditions.keys(),
+                    self.conditions_numerical + self.conditions_categorical)))
+        n_samples = len(conditions[self.conditions[0]])
+        # Samples with category values unseen in training use the partial RF.
+        unseen = np.array([any(conditions[cat][k] not in
+                self.categories_to_val_map[cat]
+                for cat in self.conditions_categorical)
+            for k in xrange(n_samples)], dtype=bool)
+        X_numerical = np.array([np.asarray(conditions[col], dtype=float)
+            for col in self.conditions_numerical]).T.reshape(n_samples, -1)
+        classes = self.rf_partial.classes_
+        distributions = np.zeros((n_samples, len(classes)))
+        if unseen.any():
+            distributions[unseen] = self.rf_partial.predict_proba(
+                X_numerical[unseen])
+        seen = ~unseen
+        if seen.any():
+            X_categorical = np.array([utils.binarize_categorical_row(
+                    self.conditions_categorical, self.categories_to_val_map,
+                    [conditions[col][k] for col in self.conditions_categorical])
+                for k in np.flatnonzero(seen)]).reshape(seen.sum(), -1)
+            distributions[seen] = self.rf_full.predict_proba(
+                np.hstack((X_numerical[seen], X_categorical)))
+        return distributions, classes
@@ -116,7 +116,8 @@ def quick_similar_rows(self, identify_row_by, nsimilar=10):
   """
   import hashlib
   table_name = 'tmptbl_' + hashlib.md5('\x00'.join(
-      [repr(identify_row_by), str(self.status)])).hexdigest()
+      [repr(identify_row_by), str(self.status),
+       self.table_fingerprint()['content']])).hexdigest()
   column_name = 'similarity_to_' + "__".join(
       re.sub(r'\W', '_', str(val)) for val in identify_row_by.values())
   query_params = []
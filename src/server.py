@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""A local HTTP server answering BQL queries on a Population.
+
+``POST /query`` with a JSON body ``{"bql": ..., "bindings": [...]}`` runs the
+query, in which %t and %g stand for the population's table and generator,
+and answers ``{"columns": [...], "rows": [[...], ...]}``.  ``GET /metrics``
+answers with request and batch counts, queue depth and latency percentiles.
+
+Queries arriving within `window` seconds of one another are gathered
+together.  They still run one by one, but within one savepoint, so the
+metamodels load each generator's models once for all of them instead of
+once per query.  Identical queries with identical bindings run only once
+and share their answer.  Queries all run on the population's one
+connection, in a worker thread, so the server stays responsive meanwhile.
+"""
+
+import collections
+import json
+import Queue
+import threading
+import time
+
+from tornado import gen
+from tornado import ioloop
+from tornado import web
+from tornado.concurrent import Future
+
+# How many recent request latencies the metrics summarize.
+LATENCY_SAMPLES = 1000
+
+class QueryBatcher(object):
+    """Runs submitted queries on a population, in its own thread.
+
+    Queries submitted close together are gathered into a batch.  Each
+    batch runs its distinct queries one after another within one
+    savepoint, and answers duplicates from the first run.
+
+    Parameters
+    ----------
+    population : bdbcontrib.Population
+        The population to query.  Nothing else should use its connection
+        while the batcher runs.
+    window : float
+        Seconds to wait, after a query arrives, for others to batch with it.
+    max_batch : int
+        The most queries to run in one batch.
+    io_loop : tornado.ioloop.IOLoop, optional
+        The loop on which to resolve the futures `submit` returns.  By
+        default, the current one.
+    """
+
+    def __init__(self, population, window=0.005, max_batch=64, io_loop=None):
+        self.population = population
+        self.window = window
+        self.max_batch = max_batch
+        self.io_loop = io_loop or ioloop.IOLoop.current()
+        self.requests = Queue.Queue()
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.counts = collections.Counter()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='bdbcontrib-query-batcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, bql, bindings=()):
+        """Queue a query; return a Future of its columns and rows."""
+        future = Future()
+        self.requests.put((bql, tuple(bindings), future, time.time()))
+        return future
+
+    def stop(self):
+        """Finish the queries already submitted, then stop."""
+        self.requests.put(None)
+        self._thread.join()
+
+    def metrics(self):
+        """Return a dict of counts, queue depth and latency percentiles."""
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1,
+                                 int(p / 100. * len(latencies)))]
+        counts = dict(self.counts)
+        return {
+            'requests': counts.get('requests', 0),
+            'executions': counts.get('executions', 0),
+            'batches': counts.get('batches', 0),
+            'errors': counts.get('errors', 0),
+            'mean_batch_size': (float(counts.get('requests', 0)) /
+                                max(1, counts.get('batches', 0))),
+            'queue_depth': self.requests.qsize(),
+            'latency_seconds': {
+                'p50': percentile(50),
+                'p90': percentile(90),
+                'p99': percentile(99),
+                'max': latencies[-1] if latencies else None,
+            },
+        }
+
+    def _run(self):
+        while not self._stopping:
+            request = self.requests.get()
+            if request is None:
+                break
+            batch = [request]
+            deadline = time.time() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=remaining)
+                except Queue.Empty:
+                    break
+                if request is None:
+                    self._stopping = True
+                    break
+                batch.append(request)
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        self.counts['batches'] += 1
+        groups = collections.OrderedDict()
+        for request in batch:
+            groups.setdefault(request[0], []).append(request)
+        # BQL takes one set of bindings per statement, so the queries run
+        # one by one, but in one transaction and so on one load of the
+        # models.
+        answers = {}
+        with self.population.bdb.savepoint():
+            for bql, requests in groups.iteritems():
+                for (_bql, bindings, _future, _start) in requests:
+                    if (bql, bindings) not in answers:
+                        answers[bql, bindings] = self._answer(bql, bindings)
+        for (bql, bindings, future, start) in batch:
+            self._resolve(future, answers[bql, bindings], start)
+
+    def _answer(self, bql, bindings):
+        self.counts['executions'] += 1
+        try:
+            cursor = self.population.bdb.execute(
+                self.population.interpret_bql(bql), bindings)
+            rows = [list(row) for row in cursor]
+            columns = [desc[0] for desc in cursor.description or []]
+        except Exception as e:  # pylint: disable=broad-except
+            return (False, e)
+        return (True, {'columns': columns, 'rows': rows})
+
+    def _resolve(self, future, answer, start):
+        (ok, value) = answer
+        self.counts['requests'] += 1
+        if not ok:
+            self.counts['errors'] += 1
+        self.latencies.append(time.time() - start)
+        if ok:
+            self.io_loop.add_callback(future.set_result, value)
+        else:
+            self.io_loop.add_callback(future.set_exception, value)
+
+class QueryHandler(web.RequestHandler):
+
+    def initialize(self, batcher):
+        self.batcher = batcher
+
+    @gen.coroutine
+    def post(self):
+        try:
+            request = json.loads(self.request.body)
+            bql = request['bql']
+            bindings = request.get('bindings') or ()
+        except (ValueError, KeyError, TypeError):
+            raise web.HTTPError(400, 'Expected JSON {"bql": ..., '
+                                '"bindings": [...]}.')
+        try:
+            result = yield self.batcher.submit(bql, bindings)
+        except Exception as e:  # pylint: disable=broad-except
+            self.set_status(400)
+            self.write({'error': str(e)})
+            return
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(result, default=str))
+
+class MetricsHandler(web.RequestHandler):
+
+    def initialize(self, batcher):
+        self.batcher = batcher
+
+    def get(self):
+        self.write(self.batcher.metrics())
+
+def make_app(population, window=0.005, max_batch=64):
+    """Return a tornado Application serving `population`, and its batcher.
+
+    Call the batcher's `stop` when done with the application.
+    """
+    batcher = QueryBatcher(population, window=window, max_batch=max_batch)
+    app = web.Application([
+        (r'/query', QueryHandler, {'batcher': batcher}),
+        (r'/metrics', MetricsHandler, {'batcher': batcher}),
+    ])
+    return (app, batcher)
+
+def serve(population, port=8888, address='127.0.0.1', window=0.005,
+          max_batch=64):
+    """Serve queries on `population` over HTTP until interrupted.
+
+    Parameters
+    ----------
+    population : bdbcontrib.Population
+        The population to query.
+    port : int
+        The port to listen on.
+    address : str
+        The address to listen on.  By default, only local clients may
+        connect.
+    window : float
+        Seconds to wait, after a query arrives, for others to batch with it.
+    max_batch : int
+        The most queries to run in one batch.
+    """
+    (app, batcher) = make_app(population, window=window, max_batch=max_batch)
+    app.listen(port, address=address)
+    population.logger.info('Serving %s on http://%s:%d/query', population.name,
+                           address, port)
+    try:
+        ioloop.IOLoop.current().start()
+    finally:
+        batcher.stop()
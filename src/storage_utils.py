@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Copying BayesDB databases with the SQLite online-backup API.
+
+Snapshots are such copies, compacted and labelled with a manifest, meant to
+be opened read-mostly by serving processes.  They are ordinary bdb files,
+so the OS can memory-map them and share their pages among processes.
+"""
+
+import os
+
+import apsw
+
+from bayeslite.exception import BayesLiteException as BLE
+
+# Number of pages to copy per backup step.  Between steps, other
+# connections may use the source database.
+BACKUP_STEP_PAGES = 1024
+
+def backup_bdb(bdb, pathname):
+    """Copy the contents of `bdb` into the database at `pathname`.
+
+    Anything already at `pathname` is replaced.  `bdb` may be in memory.
+    The copy reflects everything visible to `bdb`'s connection, including
+    changes in its open transaction, if any.
+
+    Parameters
+    ----------
+    bdb : bayeslite.BayesDB
+        The database to copy.
+    pathname : str
+        Where to write the copy, or ':memory:'.
+    """
+    dest = apsw.Connection(pathname)
+    try:
+        copy_connection(sqlite3_connection(bdb), dest)
+    finally:
+        dest.close()
+
+def restore_bdb(bdb, pathname):
+    """Replace the contents of `bdb` with those of the database at `pathname`.
+
+    Parameters
+    ----------
+    bdb : bayeslite.BayesDB
+        The database to overwrite, typically in memory.
+    pathname : str
+        The database to copy, e.g. one written by backup_bdb.
+    """
+    source = apsw.Connection(pathname, flags=apsw.SQLITE_OPEN_READONLY)
+    try:
+        copy_connection(source, sqlite3_connection(bdb))
+    finally:
+        source.close()
+
+def sqlite3_connection(bdb):
+    """Return the apsw connection underlying `bdb`.
+
+    bayeslite has no public accessor for it, so this is the only place
+    that reaches into the BayesDB object; everything else goes through here.
+    """
+    return bdb._sqlite3
+
+def copy_bdb(source, dest):
+    """Copy the main database of BayesDB `source` into BayesDB `dest`."""
+    copy_connection(sqlite3_connection(source), sqlite3_connection(dest))
+
+def copy_connection(source, dest):
+    """Copy the main database of apsw connection `source` into `dest`."""
+    with dest.backup('main', source, 'main') as backup:
+        while not backup.done:
+            backup.step(BACKUP_STEP_PAGES)
+
+# Version of the layout of snapshots' manifests.
+SNAPSHOT_FORMAT = 1
+
+# Bytes of a snapshot to memory-map when serving from it.
+SNAPSHOT_MMAP_SIZE = 2**30
+
+def export_snapshot(bdb, pathname, manifest):
+    """Write a compact copy of `bdb`, labelled with `manifest`, to `pathname`.
+
+    Parameters
+    ----------
+    bdb : bayeslite.BayesDB
+        The database to copy.
+    pathname : str
+        Where to write the snapshot.  Anything there is replaced.
+    manifest : dict
+        Strings to numbers or strings, describing the snapshot.  Read it
+        back with read_snapshot_manifest.
+    """
+    dest = apsw.Connection(pathname)
+    try:
+        copy_connection(sqlite3_connection(bdb), dest)
+        cursor = dest.cursor()
+        # A copy of a write-ahead-logged database is one too; a snapshot
+        # should stand alone in one file.
+        cursor.execute('PRAGMA journal_mode = DELETE')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bdbcontrib_snapshot (
+                key TEXT NOT NULL PRIMARY KEY,
+                value
+            )
+        ''')
+        cursor.execute('DELETE FROM bdbcontrib_snapshot')
+        manifest = dict(manifest, format=SNAPSHOT_FORMAT)
+        for key, value in sorted(manifest.iteritems()):
+            cursor.execute('''
+                INSERT INTO bdbcontrib_snapshot (key, value) VALUES (?, ?)
+            ''', (key, value))
+        cursor.execute('VACUUM')
+    finally:
+        dest.close()
+
+def read_snapshot_manifest(pathname):
+    """Return the manifest of the snapshot at `pathname`, as a dict."""
+    if not os.path.exists(pathname):
+        raise BLE(IOError('No snapshot at %s.' % (pathname,)))
+    conn = apsw.Connection(pathname, flags=apsw.SQLITE_OPEN_READONLY)
+    try:
+        manifest = dict(conn.cursor().execute(
+            'SELECT key, value FROM bdbcontrib_snapshot'))
+    except apsw.SQLError:
+        raise BLE(ValueError('%s is not a snapshot.' % (pathname,)))
+    finally:
+        conn.close()
+    if manifest.get('format') != SNAPSHOT_FORMAT:
+        raise BLE(ValueError('Snapshot %s has unknown format %r.'
+                             % (pathname, manifest.get('format'))))
+    return manifest
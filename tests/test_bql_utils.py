@@ -122,6 +122,13 @@ def test_cursor_to_df():
                 ' where 0 = 1'))
 
 
+def test_modelset_bql():
+    assert '' == bql_utils.modelset_bql([])
+    assert '3' == bql_utils.modelset_bql([3])
+    assert '0-3, 7' == bql_utils.modelset_bql([2, 0, 7, 1, 3])
+    assert '0, 2, 4-5' == bql_utils.modelset_bql([4, 0, 5, 2])
+
+
 def test_is_plotting_command():
     cmd1 = '.heatmap ESTIMATE PAIRWISE DEPENDENCE PROBABILITY FROM t; -f z.png'
     cmd2 = '.show SELECT a, b FROM t LIMIT 10; --no-contour'
@@ -216,3 +223,78 @@ def test_describe_columns_and_column_type():
             stattype = resultdf[resultdf['name'] == column]['stattype'].iloc[0]
             assert re.match(expected_type, stattype), column
             assert re.match(expected_type, dts.get_column_stattype(column))
+
+def test_query_model_subsets():
+    with prepare() as (dts, _df):
+        bql = 'ESTIMATE DEPENDENCE PROBABILITY OF floats_1 WITH few_ints_3 BY %g'
+        full = dts.query(bql).iloc[0, 0]
+        nmodels = len(dts.per_model_analysis_status())
+        some = dts.query(bql, models=3, seed=0).iloc[0, 0]
+        assert 0 <= some <= 1
+        assert some == dts.query(bql, models=3, seed=0).iloc[0, 0]
+        # Any integral count will do.
+        import numpy
+        assert some == dts.query(bql, models=long(3), seed=0).iloc[0, 0]
+        assert some == dts.query(bql, models=numpy.int64(3),
+                                 seed=0).iloc[0, 0]
+        one = dts.query(bql, models=[0]).iloc[0, 0]
+        assert one in (0, 1)
+        # No models were lost.
+        assert nmodels == len(dts.per_model_analysis_status())
+
+        steps = list(dts.query_progressively(bql, batch=4, seed=0))
+        assert [4, 8, nmodels] == [n for (n, _est, _se) in steps][:2] + [
+            steps[-1][0]]
+        (_n, estimate, standard_error) = steps[0]
+        assert standard_error.isnull().all().all()
+        (_n, estimate, standard_error) = steps[-1]
+        assert abs(full - estimate.iloc[0, 0]) < 1e-9
+        assert 0 <= standard_error.iloc[0, 0]
+        assert nmodels == len(dts.per_model_analysis_status())
+
+def test_query_to_file():
+    import json
+    import numpy
+    import os
+    import shutil
+    with prepare() as (dts, df):
+        tempd = tempfile.mkdtemp(prefix="bdbcontrib-test-bql-utils")
+        try:
+            path = os.path.join(tempd, 'out.csv')
+            report = dts.query_to_file(
+                'SELECT floats_1, categorical_1 FROM %t', path, chunk_rows=7)
+            assert len(df) == report['rows']
+            assert 0 < report['rows_per_second']
+            with open(path) as f:
+                lines = f.read().splitlines()
+            assert 'floats_1,categorical_1' == lines[0]
+            assert len(df) + 1 == len(lines)
+
+            path = os.path.join(tempd, 'out.npy')
+            dts.query_to_file('SELECT floats_1, floats_3 FROM %t', path,
+                              format='npy', chunk_rows=7)
+            array = numpy.load(path)
+            assert (len(df), 2) == array.shape
+            expected = dts.query('SELECT floats_1, floats_3 FROM %t')
+            assert numpy.allclose(expected.values, array, equal_nan=True)
+            with pytest.raises(Exception):
+                dts.query_to_file('SELECT categorical_1 FROM %t',
+                                  os.path.join(tempd, 'bad.npy'),
+                                  format='npy')
+
+            path = os.path.join(tempd, 'columns')
+            dts.query_to_file('SELECT floats_1, categorical_1 FROM %t', path,
+                              format='columnar', chunk_rows=7)
+            with open(os.path.join(path, 'columns.json')) as f:
+                manifest = json.load(f)
+            assert len(df) == manifest['rows']
+            assert ['floats_1', 'categorical_1'] == [
+                c['name'] for c in manifest['columns']]
+            floats = numpy.load(os.path.join(path, manifest['columns'][0]['file']))
+            assert (len(df),) == floats.shape
+            with open(os.path.join(path, manifest['columns'][1]['file'])) as f:
+                assert len(df) == len(f.read().splitlines())
+            with pytest.raises(Exception):
+                dts.query_to_file('SELECT 1', path, format='parquet')
+        finally:
+            shutil.rmtree(tempd)
@@ -14,8 +14,10 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import numpy as np
 import os
 import pytest
+import time
 
 import bayeslite
 from bayeslite.exception import BayesLiteException as BLE
@@ -24,6 +26,8 @@ from bayeslite.sqlite3_util import sqlite3_quote_name as quote
 import bdbcontrib
 from bdbcontrib.bql_utils import describe_generator, describe_generator_models
 from bdbcontrib.metamodels.composer import Composer
+from bdbcontrib.metamodels.composer import dpgmm_confidence
+from bdbcontrib.metamodels.composer import kde_confidence
 from bdbcontrib.predictors import random_forest
 from bdbcontrib.predictors import keplers_law
 from bdbcontrib.predictors import multiple_regression
@@ -395,6 +399,124 @@ def test_drop_generator():
     assert not bayeslite.core.bayesdb_has_generator(bdb, 't1_cc')
     bdb.close()
 
+def test_compiled():
+    bdb = bayeslite.bayesdb_open()
+    bayeslite.bayesdb_read_csv_file(bdb, 'satellites', PATH_SATELLITES_CSV,
+        header=True, create=True)
+    composer = Composer(n_samples=5)
+    bayeslite.bayesdb_register_metamodel(bdb, composer)
+    composer.register_foreign_predictor(keplers_law.KeplersLaw)
+    bdb.execute('''
+        CREATE GENERATOR t1 FOR satellites USING composer(
+            default (
+                Perigee_km NUMERICAL, Apogee_km NUMERICAL,
+                Class_of_orbit CATEGORICAL
+            ),
+            keplers_law (
+                Period_minutes NUMERICAL
+                    GIVEN Perigee_km, Apogee_km
+            )
+        );''')
+    genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+    cc_id = bayeslite.core.bayesdb_get_generator(bdb, 't1_cc')
+    colno = lambda g, name: \
+        bayeslite.core.bayesdb_generator_column_number(bdb, g, name)
+    period = colno(genid, 'period_minutes')
+    perigee = colno(genid, 'perigee_km')
+    apogee = colno(genid, 'apogee_km')
+    # Outside a transaction, the catalog is read afresh.
+    assert composer.compiled(bdb, genid) is not composer.compiled(bdb, genid)
+    with bdb.savepoint():
+        compiled = composer.compiled(bdb, genid)
+        # Read from the catalog once per transaction.
+        assert compiled is composer.compiled(bdb, genid)
+        assert cc_id == compiled.cc_id == composer.cc_id(bdb, genid)
+        assert set([period]) == compiled.fcols
+        assert set([perigee, apogee, colno(genid, 'class_of_orbit')]) == \
+            compiled.lcols
+        assert sorted([perigee, apogee]) == compiled.parents[period]
+        assert [period] == compiled.topo
+        assert 'keplers_law' == composer.predictor_name(bdb, genid, period)
+        assert [colno(cc_id, 'apogee_km')] == \
+            composer.cc_colnos(bdb, genid, [apogee])
+        assert set() == composer.pcols(bdb, genid, apogee)
+        # Crosscat predicts local columns, whatever their stattype.
+        bdb.execute('INITIALIZE 1 MODEL FOR t1')
+        orbit = colno(genid, 'class_of_orbit')
+        compiled.stattypes[orbit] = 'cyclic'
+        assert 1 == len(composer.predict_confidence_batch(bdb, genid, 0,
+            orbit, [1]))
+        bdb.execute('DROP GENERATOR t1')
+        assert (genid, 'compiled') not in composer._predictor_cache(bdb)
+    bdb.close()
+
+def test_model_processes():
+    bdb = bayeslite.bayesdb_open()
+    bayeslite.bayesdb_read_csv_file(bdb, 'satellites', PATH_SATELLITES_CSV,
+        header=True, create=True)
+    bdbcontrib.bql_utils.nullify(bdb, 'satellites', 'NaN')
+    composer = Composer(n_samples=5, processes=2)
+    composer.register_foreign_predictor(keplers_law.KeplersLaw)
+    bayeslite.bayesdb_register_metamodel(bdb, composer)
+    bdb.execute('''
+        CREATE GENERATOR t1 FOR satellites USING composer(
+            default (
+                Perigee_km NUMERICAL, Apogee_km NUMERICAL,
+                Eccentricity NUMERICAL
+            ),
+            keplers_law (
+                Period_minutes NUMERICAL
+                    GIVEN Perigee_km, Apogee_km
+            )
+        );''')
+    bdb.execute('INITIALIZE 3 MODELS FOR t1')
+    genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+    colno = lambda name: \
+        bayeslite.core.bayesdb_generator_column_number(bdb, genid, name)
+    targets = [(1, colno('Period_minutes'), 1020)]
+    constraints = [(1, colno('Apogee_km'), 38000),
+                   (1, colno('Perigee_km'), 35000)]
+    try:
+        # Exact densities agree whether or not models run in workers.
+        parallel = composer.logpdf_joint(bdb, genid, targets, constraints,
+            None)
+        assert composer.model_pool is not None
+        assert 0 <= composer.column_dependence_probability(bdb, genid, None,
+            colno('Period_minutes'), colno('Eccentricity')) <= 1
+        composer.column_mutual_information(bdb, genid, None,
+            colno('Period_minutes'), colno('Eccentricity'), numsamples=5)
+        # Changing the models retires the workers' copies, not the workers.
+        pool = composer.model_pool
+        bdb.execute('ANALYZE t1 FOR 1 ITERATION WAIT')
+        composer.processes = None
+        serial = composer.logpdf_joint(bdb, genid, targets, constraints, None)
+        composer.processes = 2
+        assert abs(serial - composer.logpdf_joint(bdb, genid, targets,
+            constraints, None)) < 1e-9
+        assert pool[2] is composer.model_pool[2]
+        assert pool[1] != composer.model_pool[1]
+        # So does changing them behind the composer's back, as appending
+        # rows or merging parallel analyses does, and nothing else.
+        pool = composer.model_pool
+        composer.logpdf_joint(bdb, genid, targets, constraints, None)
+        assert pool == composer.model_pool
+        bdb.sql_execute('UPDATE bayesdb_crosscat_theta'
+            ' SET theta_json = theta_json')
+        composer.logpdf_joint(bdb, genid, targets, constraints, None)
+        assert pool[1] != composer.model_pool[1]
+        # And dropping models for a while and rolling that back, though it
+        # brings back the models as they were.
+        pool = composer.model_pool
+        with bdbcontrib.bql_utils.restrict_models(bdb, 't1', [0, 1]):
+            composer.logpdf_joint(bdb, genid, targets, constraints, None)
+        composer.logpdf_joint(bdb, genid, targets, constraints, None)
+        assert pool[1] != composer.model_pool[1]
+        assert pool[2] is composer.model_pool[2]
+    finally:
+        composer.close_model_pool()
+    assert parallel != float('-inf')
+    bdb.close()
+
 def test_composer_integration__ci_slow():
     # But currently difficult to seperate these tests into smaller tests because
     # of their sequential nature. We will still test all internal functions
@@ -603,6 +725,34 @@ def test_composer_integration__ci_slow():
             GIVEN Period_minutes = 1432, Anticipated_Lifetime = 5 LIMIT 2;
     ''')
     assert len(curs.fetchall()) == 2
+    # Many predictions resample from few pools, within the sample budget.
+    pools = []
+    weighted_sample = composer._weighted_sample
+    def counting_weighted_sample(*args, **kwargs):
+        pools.append(kwargs['n_samples'])
+        return weighted_sample(*args, **kwargs)
+    composer._weighted_sample = counting_weighted_sample
+    try:
+        curs = bdb.execute('''
+            SIMULATE Country_of_Operator FROM t1
+                GIVEN Period_minutes = 1432 LIMIT 50;
+        ''')
+        assert len(curs.fetchall()) == 50
+    finally:
+        del composer._weighted_sample
+    assert len(pools) < 50
+    assert sum(pools) <= 50 * composer.n_samples
+    # Without foreign evidence, one forward sample per prediction.
+    del pools[:]
+    composer._weighted_sample = counting_weighted_sample
+    try:
+        curs = bdb.execute('''
+            SIMULATE Period_minutes FROM t1 GIVEN Apogee_km = 1000 LIMIT 7;
+        ''')
+        assert len(curs.fetchall()) == 7
+    finally:
+        del composer._weighted_sample
+    assert [7] == pools
     # Simulate joint foreign conditioned on third foreign.
     curs = bdb.execute('''
         SIMULATE Period_minutes, Anticipated_Lifetime FROM t1
@@ -650,6 +800,53 @@ def test_composer_integration__ci_slow():
         ESTIMATE PROBABILITY OF Type_of_Orbit = 'Polar' FROM t1 LIMIT 1;
     ''')
     assert curs.next()[0] <= 1.
+    # Foreign given all its parents, and local given local, are exact.
+    genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+    colno = lambda name: \
+        bayeslite.core.bayesdb_generator_column_number(bdb, genid, name)
+    period, apogee, perigee = map(colno,
+        ['Period_minutes', 'Apogee_km', 'Perigee_km'])
+    with bdb.savepoint():
+        colnames = composer.compiled(bdb, genid).colnames
+        Y = [(1, apogee, 38000), (1, perigee, 35000)]
+        expected = composer.predictor(bdb, genid, period).logpdf(1020,
+            {colnames[apogee]: 38000, colnames[perigee]: 35000})
+        assert expected == composer._joint_logpdf(bdb, genid, 0,
+            [(1, period, 1020)], Y)
+        expected = composer.cc(bdb, genid).logpdf_joint(bdb,
+            composer.cc_id(bdb, genid),
+            [(1, composer.cc_colno(bdb, genid, apogee), 38000)],
+            [(1, composer.cc_colno(bdb, genid, perigee), 35000)], 0)
+        assert expected == composer._joint_logpdf(bdb, genid, 0,
+            [(1, apogee, 38000)], [(1, perigee, 35000)])
+        # A foreign column missing a parent is not.
+        assert composer._exact_joint_logpdf(bdb, genid, 0,
+            [(1, period, 1020)], [(1, apogee, 38000)]) is None
+        # Sampled from a seed, the evidence-only terms are memoized for the
+        # query.
+        composer._joint_logpdf(bdb, genid, 0, [(1, period, 1020)],
+            [(1, apogee, 38000)], seed=3)
+        memo = set(k for k in composer._predictor_cache(bdb)
+                   if k[:2] == (genid, 'evidence'))
+        assert 2 == len(memo)
+        composer._joint_logpdf(bdb, genid, 0, [(1, period, 1200)],
+            [(1, apogee, 38000)], seed=3)
+        assert memo == set(k for k in composer._predictor_cache(bdb)
+                           if k[:2] == (genid, 'evidence'))
+        composer._forget_evidence(bdb, genid)
+        assert not any(k[:2] == (genid, 'evidence')
+                       for k in composer._predictor_cache(bdb))
+        # Seeded, sampled densities are reproducible, also when crosscat
+        # simulates a local query column.
+        Qs = [[(1, apogee, 38000)], [(1, apogee, 1000)]]
+        Y = [(1, period, 1020)]
+        draw = bdb.np_prng.get_state()[1].tolist()
+        first = composer._joint_logpdfs(bdb, genid, 0, Qs, Y, [3, 4])
+        # The bdb's own random numbers are left alone.
+        assert draw == bdb.np_prng.get_state()[1].tolist()
+        composer._forget_evidence(bdb, genid)
+        assert list(first) == list(composer._joint_logpdfs(bdb, genid, 0,
+            Qs, Y, [3, 4]))
     # Query inconsistent with evidence should be 0.
     curs = bdb.execute('''
         ESTIMATE PROBABILITY OF "Type_of_Orbit" = 'Polar'
@@ -688,6 +885,41 @@ def test_composer_integration__ci_slow():
     # assert 0. <= curs.next()[0]
     assert float("-inf") <= curs.next()[0]
 
+    # By default estimates spend every sample, in batches. Asked to, they
+    # stop drawing once the standard error is within tolerance.
+    assert 0 == composer.mi_tolerance
+    batches = []
+    simulate = composer.simulate
+    def counting_simulate(*args, **kwargs):
+        batches.append(kwargs['numpredictions'])
+        return simulate(*args, **kwargs)
+    composer.simulate = counting_simulate
+    try:
+        X = [(1, period)]
+        W = [(1, colno('Anticipated_Lifetime'))]
+        composer.mi_tolerance = float('inf')
+        composer.conditional_mutual_information(bdb, genid, 0, X, W, [], [],
+            numsamples=50)
+        assert [20] == batches
+        del batches[:]
+        composer.mi_tolerance = 0
+        composer.conditional_mutual_information(bdb, genid, 0, X, W, [], [],
+            numsamples=50)
+        assert [20, 20, 10] == batches
+    finally:
+        del composer.simulate
+        composer.mi_tolerance = 0
+    # With a local column too, a seeded estimate is reproducible, as the
+    # terms of each draw share all their random numbers.
+    estimates = []
+    for _ in range(2):
+        bdb.np_prng.seed(0)
+        bdb.py_prng.seed(0)
+        estimates.append(composer.conditional_mutual_information(bdb, genid,
+            0, [(1, period)], [(1, colno('longitude_radians_of_geo'))], [],
+            [], numsamples=10))
+    assert estimates[0] == estimates[1]
+
     # -----------------------
     # TEST PREDICT CONFIDENCE
     # -----------------------
@@ -717,6 +949,22 @@ def test_composer_integration__ci_slow():
         INFER EXPLICIT PREDICT Type_of_Orbit CONFIDENCE c FROM t1 LIMIT 1;
     ''')
     assert 0 <= curs.next()[1] <= 1
+    # Many rows at once, including rows missing foreign parents.
+    rowids = [row[0] for row in bdb.sql_execute('''
+        SELECT _rowid_ FROM satellites WHERE Anticipated_Lifetime IS NULL
+            OR Power_watts IS NULL LIMIT 5
+    ''')] + [row[0] for row in bdb.sql_execute('''
+        SELECT _rowid_ FROM satellites LIMIT 5
+    ''')]
+    for name in ['Type_of_Orbit', 'Period_minutes', 'Anticipated_Lifetime',
+                 'Contractor', 'Dry_Mass_kg']:
+        predictions = composer.predict_confidence_batch(bdb, genid, 0,
+            colno(name), rowids, numsamples=5)
+        assert len(rowids) == len(predictions)
+        assert all(value is not None and 0 <= conf
+                   for value, conf in predictions)
+    with pytest.raises(BLE):
+        composer.predict_confidence_batch(bdb, genid, 0, period, [10**9])
 
     bdb.close()
 
@@ -732,3 +980,30 @@ def test_topological_sort():
     graph = {1:[], 2:[1], 3:[2,4,6], 4:[2], 5:[3,4], 6:[4,5,1]}
     with pytest.raises(BLE):
         topo = Composer.topological_sort(graph)
+
+def test_kde_confidence():
+    prng = np.random.RandomState(0)
+    assert 1 == kde_confidence([3.] * 10)
+    assert 0.8 < kde_confidence(prng.normal(size=100))
+    bimodal = np.concatenate((prng.normal(-10, 1, size=50),
+        prng.normal(10, 1, size=50)))
+    assert 0.3 < kde_confidence(bimodal) < 0.7
+    assert 0.3 < kde_confidence(bimodal, grid=16) < 0.7
+
+def test_numerical_confidence_benchmark__ci_slow():
+    # The default estimator should be much faster than the DPGMM, and agree
+    # with it on clear cases.
+    prng = np.random.RandomState(0)
+    unimodal = [prng.normal(size=100) for _ in xrange(10)]
+    bimodal = [np.concatenate((prng.normal(-10, 1, size=50),
+        prng.normal(10, 1, size=50))) for _ in xrange(10)]
+    timings = {}
+    for name, confidence in [('kde', kde_confidence),
+                             ('dpgmm', dpgmm_confidence)]:
+        start = time.time()
+        unimodal_confs = [confidence(s) for s in unimodal]
+        bimodal_confs = [confidence(s) for s in bimodal]
+        timings[name] = time.time() - start
+        assert 0.7 < np.mean(unimodal_confs)
+        assert np.mean(bimodal_confs) < 0.7
+    assert timings['kde'] < timings['dpgmm']
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# matplotlib needs to set the backend before anything else gets to.
+import matplotlib
+matplotlib.use('Agg')
+
+import os
+import pytest
+import shutil
+import tempfile
+import threading
+
+from bayeslite.exception import BayesLiteException as BLE
+from bdbcontrib.connection_pool import ConnectionPool
+
+from test_population import fresh_population
+
+def test_connection_pool():
+    with pytest.raises(BLE):
+        ConnectionPool(':memory:')
+    tempd = tempfile.mkdtemp(prefix="bdbcontrib-test-connection-pool")
+    try:
+        dts = fresh_population(bdb_path=os.path.join(tempd, "data.bdb"))
+        dts.analyze(models=2, iterations=1)
+        expected = dts.query('SELECT COUNT(*) FROM %t').iloc[0, 0]
+        with dts.connection_pool(size=2) as pool:
+            assert 2 == len(pool)
+            results = []
+            def reader():
+                results.append(pool.query('SELECT COUNT(*) FROM %t').iloc[0, 0])
+                pool.query('ESTIMATE PREDICTIVE PROBABILITY OF floats_1 '
+                           'FROM %g LIMIT 2')
+            threads = [threading.Thread(target=reader) for _ in range(6)]
+            for thread in threads:
+                thread.start()
+            # The population's own connection can still write meanwhile.
+            dts.analyze(models=0, iterations=1)
+            for thread in threads:
+                thread.join()
+            assert [expected] * 6 == results
+            with pytest.raises(Exception):
+                pool.query('DELETE FROM %t')
+            with pool.connection() as bdb:
+                with pytest.raises(BLE):
+                    with pool.connection(timeout=0.1) as other:
+                        with pool.connection(timeout=0.1) as third:
+                            pass
+    finally:
+        shutil.rmtree(tempd)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# matplotlib needs to set the backend before anything else gets to.
+import matplotlib
+matplotlib.use('Agg')
+
+import os
+import shutil
+import tempfile
+
+from bdbcontrib import cost_model
+
+from test_population import fresh_population
+from test_population import prepare
+
+def test_query_shape():
+    assert 'pairwise_rows' == cost_model.query_shape(
+        'ESTIMATE SIMILARITY FROM PAIRWISE t_cc')
+    assert 'pairwise_columns' == cost_model.query_shape(
+        'ESTIMATE DEPENDENCE PROBABILITY FROM PAIRWISE COLUMNS OF t_cc')
+    assert 'pairwise_columns_mutual_information' == cost_model.query_shape(
+        'ESTIMATE MUTUAL INFORMATION\n FROM PAIRWISE COLUMNS OF t_cc')
+    assert 'columns' == cost_model.query_shape(
+        'ESTIMATE * FROM COLUMNS OF t_cc')
+    assert 'rows' == cost_model.query_shape(
+        'ESTIMATE PREDICTIVE PROBABILITY OF x FROM t_cc')
+    assert cost_model.query_shape('SELECT * FROM t') is None
+    assert cost_model.is_pairwise('ESTIMATE SIMILARITY FROM PAIRWISE t_cc')
+    assert not cost_model.is_pairwise('SELECT * FROM t')
+    assert 't_cc' == cost_model.pairwise_generator(
+        'ESTIMATE SIMILARITY FROM PAIRWISE t_cc')
+    assert 't_cc' == cost_model.pairwise_generator(
+        'ESTIMATE DEPENDENCE PROBABILITY FROM PAIRWISE COLUMNS OF "t_cc"')
+    assert cost_model.pairwise_generator('SELECT * FROM t') is None
+
+def test_explain_cost():
+    with prepare() as (dts, df):
+        pairwise = dts.explain_cost('ESTIMATE SIMILARITY FROM PAIRWISE %g')
+        assert len(df) == pairwise['rows']
+        assert 10 <= pairwise['models']
+        assert 1 <= pairwise['views'] <= pairwise['columns']
+        rows = dts.explain_cost('ESTIMATE PREDICTIVE PROBABILITY OF floats_1'
+                                ' FROM %g')
+        assert 0 < rows['seconds'] < pairwise['seconds']
+        assert pairwise['units'] == len(df) * rows['units']
+        assert 0 == dts.explain_cost('SELECT * FROM %t')['seconds']
+
+def test_route_expensive_query(monkeypatch):
+    monkeypatch.setattr(cost_model, 'EXPENSIVE_SECONDS', 0)
+    tempd = tempfile.mkdtemp(prefix="bdbcontrib-test-cost-model")
+    try:
+        dts = fresh_population(num_rows=10,
+                               bdb_path=os.path.join(tempd, "data.bdb"))
+        dts.analyze(models=2, iterations=1)
+        routed = dts.query('ESTIMATE SIMILARITY FROM PAIRWISE %g')
+        assert ['rowid0', 'rowid1', 'value'] == list(routed.columns)
+        assert 100 == len(routed)
+        direct = dts.bdb.execute('ESTIMATE SIMILARITY FROM PAIRWISE %s'
+                                 % (dts.generator_name,)).fetchall()
+        assert (sorted(tuple(row[-3:]) for row in direct) ==
+                sorted(map(tuple, routed.values.tolist())))
+        # Expensive queries that cannot be routed still run.
+        dts.query('ESTIMATE DEPENDENCE PROBABILITY FROM PAIRWISE COLUMNS'
+                  ' OF %g')
+        # Queries are costed against the generator they name.
+        other = dts.generator_name + '_other'
+        dts.query('CREATE GENERATOR %s FOR %%t USING crosscat(GUESS(*))'
+                  % (other,))
+        dts.query('INITIALIZE 1 MODEL FOR %s' % (other,))
+        assert 100 == len(dts.query('ESTIMATE SIMILARITY FROM PAIRWISE %s'
+                                    % (other,)))
+        # A failing cost estimate does not fail the query.
+        def broken(*_args, **_kwargs):
+            raise ValueError('no estimate')
+        monkeypatch.setattr(cost_model, 'explain_cost', broken)
+        assert 100 == len(dts.query('ESTIMATE SIMILARITY FROM PAIRWISE %g'))
+    finally:
+        shutil.rmtree(tempd)
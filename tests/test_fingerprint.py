@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import bayeslite
+from bayeslite.exception import BayesLiteException as BLE
+import pytest
+
+from bdbcontrib.fingerprint import row_digest
+from bdbcontrib.fingerprint import table_fingerprint
+
+def make_table(bdb, name, rows):
+    bdb.sql_execute('CREATE TABLE %s (a INTEGER, b TEXT)' % (name,))
+    for row in rows:
+        bdb.sql_execute('INSERT INTO %s (a, b) VALUES (?, ?)' % (name,), row)
+
+def test_table_fingerprint():
+    rows = [(1, 'one'), (2, 'two'), (3, None)]
+    with bayeslite.bayesdb_open() as bdb:
+        with pytest.raises(BLE):
+            table_fingerprint(bdb, 'nosuchtable')
+        make_table(bdb, 't', rows)
+        make_table(bdb, 'u', list(reversed(rows)))
+        fp = table_fingerprint(bdb, 't')
+        assert 3 == fp['rows']
+        assert 2 == fp['columns']
+        # Independent of row order and of how the fingerprint was computed.
+        assert fp['content'] == table_fingerprint(bdb, 'u')['content']
+        assert fp == table_fingerprint(bdb, 't')
+
+        # Appends are hashed incrementally and match a full hash.
+        bdb.sql_execute("INSERT INTO t (a, b) VALUES (4, 'four')")
+        bdb.sql_execute("INSERT INTO u (a, b) VALUES (4, 'four')")
+        appended = table_fingerprint(bdb, 't')
+        assert 4 == appended['rows']
+        assert appended['content'] != fp['content']
+        assert appended['content'] == table_fingerprint(bdb, 'u')['content']
+
+        # Updates force a rehash.
+        bdb.sql_execute("UPDATE t SET b = 'uno' WHERE b = 'one'")
+        changed = table_fingerprint(bdb, 't')
+        assert changed['content'] != appended['content']
+        bdb.sql_execute("UPDATE t SET b = 'one' WHERE b = 'uno'")
+        assert appended == table_fingerprint(bdb, 't')
+
+        bdb.sql_execute('DELETE FROM t WHERE a = 4')
+        assert fp == table_fingerprint(bdb, 't')
+
+        bdb.sql_execute('ALTER TABLE t ADD COLUMN c REAL')
+        altered = table_fingerprint(bdb, 't')
+        assert 3 == altered['columns']
+        assert altered['schema'] != fp['schema']
+
+        # Dropping and recreating the table, as Population.reset does,
+        # leaves no triggers behind to mark the old fingerprint stale.
+        bdb.sql_execute('DROP TABLE u')
+        make_table(bdb, 'u', [(5, 'five'), (6, 'six'), (7, 'seven')])
+        recreated = table_fingerprint(bdb, 'u')
+        assert 3 == recreated['rows']
+        assert recreated['content'] != fp['content']
+        make_table(bdb, 'v', [(5, 'five'), (6, 'six'), (7, 'seven')])
+        assert recreated['content'] == table_fingerprint(bdb, 'v')['content']
+
+def test_row_digest():
+    assert row_digest((1, u'a')) == row_digest((1, u'a'))
+    assert row_digest((1, u'a')) != row_digest((u'a', 1))
+    assert row_digest((1,)) != row_digest((u'1',))
+    assert row_digest((1,)) != row_digest((1.0,))
+    assert row_digest((None,)) != row_digest((u'None',))
@@ -20,6 +20,7 @@ import pandas as pd
 from bdbcontrib.bql_utils import df_to_table
 from crosscat.tests import synthetic_data_generator as sdg
 
+from bdbcontrib.predictors import predictor
 from bdbcontrib.predictors.random_forest import RandomForest
 from bdbcontrib.predictors.keplers_law import KeplersLaw
 from bdbcontrib.predictors.multiple_regression import MultipleRegression
@@ -156,3 +157,30 @@ def test_multiple_regression():
     mr_predictor2.simulate(10, inputs)
     pdf_val2 = mr_predictor2.logpdf(-0.4, inputs)
     assert np.allclose(pdf_val, pdf_val2)
+
+def test_batched_predictions():
+    (bdb, table) = get_synthetic_data(150)
+    conditions = [(c, 'NUMERICAL') for c in ['c1','c2','c4','c8']] + \
+        [(c, 'CATEGORICAL') for c in ['m1', 'm3']]
+    # One row with an unseen category, two with seen ones.
+    rows = [
+        {'c1':1.3, 'c2':-2.1, 'c4':0.2, 'c8':0.2, 'm1':1, 'm3':7},
+        {'c1':1.3, 'c2':-2.1, 'c4':0.2, 'c8':0.2, 'm1':1, 'm3':4},
+        {'c1':-0.5, 'c2':0.3, 'c4':1.1, 'c8':-0.2, 'm1':2, 'm3':1},
+    ]
+    batch = {c: np.array([row[c] for row in rows]) for c in rows[0]}
+    rf_predictor = RandomForest.create(bdb, table, [('m5', 'CATEGORICAL')],
+        conditions)
+    mr_predictor = MultipleRegression.create(bdb, table, [('c7', 'NUMERICAL')],
+        conditions)
+    kl_predictor = KeplersLaw.create(bdb, table, [('c4', 'NUMERICAL')],
+        [('c1','NUMERICAL'), ('c2', 'NUMERICAL')])
+    for fp, values in [(rf_predictor, [7, -1, 5]),
+                       (mr_predictor, [-0.4, 0.1, 2.0]),
+                       (kl_predictor, [1.2, 0.3, -0.7])]:
+        assert 3 == len(fp.simulate_many(batch))
+        expected = [fp.logpdf(v, row) for v, row in zip(values, rows)]
+        assert np.allclose(expected, fp.logpdf_many(values, batch))
+        # The generic fallback agrees with the vectorized methods.
+        assert np.allclose(expected, predictor.logpdf_each(fp, values, batch))
+        assert 3 == len(predictor.simulate_each(fp, batch))
@@ -24,6 +24,7 @@ import tempfile
 import bayeslite
 from bayeslite.exception import BayesLiteException as BLE
 from bdbcontrib import parallel
+from bdbcontrib import storage_utils
 from bdbcontrib.bql_utils import cursor_to_df
 
 import test_bql_utils
@@ -187,3 +188,114 @@ def test_estimate_pairwise_similarity_long():
         )
 
         assert_frame_equal(std_sim, parallel_sim, check_column_type=True)
+
+
+def _failing_query(query_string, params, queue, bdb_file):
+    raise ValueError('Worker failed on %r' % (params,))
+
+
+def test_estimate_pairwise_similarity_worker_error(monkeypatch):
+    """
+    Tests that a worker's exception reaches the caller, rather than leaving
+    a partial similarity table behind.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.bdb') as bdb_file:
+        bdb = _initialized_bdb(bdb_file.name, n_models=1)
+        bdb.close()
+        monkeypatch.setattr(parallel, '_query_into_queue', _failing_query)
+        with pytest.raises(ValueError):
+            parallel.estimate_pairwise_similarity(
+                bdb_file.name, 't', 't_cc', cores=2
+            )
+
+
+def _initialized_bdb(pathname=None, n_models=4):
+    bdb = bayeslite.bayesdb_open(pathname)
+    with tempfile.NamedTemporaryFile() as temp:
+        temp.write(test_bql_utils.csv_data)
+        temp.seek(0)
+        bayeslite.bayesdb_read_csv_file(
+            bdb, 't', temp.name, header=True, create=True)
+    bdb.execute('''
+        CREATE GENERATOR t_cc FOR t USING crosscat (
+            GUESS(*),
+            id IGNORE
+        )
+    ''')
+    bdb.execute('INITIALIZE %d MODELS FOR t_cc' % (n_models,))
+    return bdb
+
+
+def test_analyze_models():
+    """
+    Tests that model-parallel analysis merges every model's results back,
+    and is deterministic under a seed.
+    """
+    bdb = _initialized_bdb()
+    twin = bayeslite.bayesdb_open()
+    storage_utils.copy_bdb(bdb, twin)
+
+    def thetas(b):
+        return b.sql_execute('''
+            SELECT modelno, theta_json FROM bayesdb_crosscat_theta
+                ORDER BY modelno
+        ''').fetchall()
+    initial = thetas(bdb)
+
+    parallel.analyze_models(bdb, 't_cc', iterations=3, checkpoint=1,
+                            processes=2, seed=7)
+    iterations = cursor_to_df(bdb.execute('''
+        SELECT modelno, iterations FROM bayesdb_generator_model
+    '''))
+    assert list(iterations['iterations']) == [3] * 4
+    assert thetas(bdb) != initial
+    diagnostics = bdb.sql_execute('''
+        SELECT modelno, COUNT(*) FROM bayesdb_crosscat_diagnostics
+            GROUP BY modelno ORDER BY modelno
+    ''').fetchall()
+    assert [modelno for modelno, _ in diagnostics] == range(4)
+
+    parallel.analyze_models(twin, 't_cc', iterations=3, checkpoint=1,
+                            processes=2, seed=7)
+    assert thetas(twin) == thetas(bdb)
+
+    with pytest.raises(BLE):
+        parallel.analyze_models(bdb, 't_cc', iterations=1, processes=0)
+    with pytest.raises(BLE):
+        parallel.analyze_models(bdb, 't_cc', processes=2)
+
+
+def test_analyze_generators():
+    """
+    Tests that several generators are analyzed at once and all merged back.
+    """
+    bdb = _initialized_bdb(n_models=2)
+    bdb.execute('''
+        CREATE GENERATOR t_cc2 FOR t USING crosscat (
+            GUESS(*),
+            id IGNORE
+        )
+    ''')
+    bdb.execute('INITIALIZE 3 MODELS FOR t_cc2')
+    parallel.analyze_generators(bdb, ['t_cc', 't_cc2'], iterations=2,
+                                checkpoint=1, seed=3)
+    iterations = bdb.sql_execute('''
+        SELECT g.name, m.modelno, m.iterations
+            FROM bayesdb_generator AS g, bayesdb_generator_model AS m
+            WHERE g.id = m.generator_id
+            ORDER BY g.name, m.modelno
+    ''').fetchall()
+    assert [('t_cc', 0, 2), ('t_cc', 1, 2),
+            ('t_cc2', 0, 2), ('t_cc2', 1, 2), ('t_cc2', 2, 2)] == \
+        [tuple(row) for row in iterations]
+
+    with pytest.raises(BLE):
+        parallel.analyze_generators(bdb, ['t_cc', 't_cc'], iterations=1)
+    # With fewer processes than generators, a time budget is split among
+    # the rounds of generators.
+    assert 'FOR 2 MINUTES' == parallel._analysis_duration(0, 2, None)
+    assert 'FOR 40 SECONDS CHECKPOINT 1 ITERATION' == \
+        parallel._analysis_duration(0, 2, 1, rounds=3)
+
+    with pytest.raises(BLE):
+        parallel.analyze_generators(bdb, ['t_cc', 't_cc2'])
@@ -37,7 +37,7 @@ import test_plot_utils
 
 from bayeslite.loggers import CaptureLogger
 
-from bdbcontrib import Population, population
+from bdbcontrib import Population, bql_utils, population
 
 testvars = {'dataset': None, 'input_df': None}
 
@@ -118,3 +118,203 @@ def test_q():
             ESTIMATE DEPENDENCE PROBABILITY OF
             floats_1 WITH categorical_1 BY %g'''))
         #resultdf.to_csv(sys.stderr, header=True)
+
+def fresh_population(num_rows=40, bdb_path=None):
+    (df, _csv_data) = test_plot_utils.dataset(num_rows)
+    name = ''.join(random.choice(ascii_lowercase) for _ in range(32))
+    return Population(name=name, df=df, bdb_path=bdb_path,
+                      logger=CaptureLogger(
+                          verbose=pytest.config.option.verbose),
+                      session_capture_name="test_population.py")
+
+def test_analyze_until_converged():
+    dts = fresh_population()
+    report = dts.analyze(models=4, iterations=12, checkpoint=2,
+                         until='converged', window=2, tolerance=1e9)
+    assert report is dts.convergence
+    assert [0, 1, 2, 3] == list(report['modelno'])
+    assert all(0 < its <= 12 and its % 2 == 0
+               for its in report['iterations']), repr(report)
+    # Models that never plateaued ran the whole budget.
+    assert all(its == 12 for (its, conv)
+               in zip(report['iterations'], report['converged'])
+               if not conv), repr(report)
+    with pytest.raises(Exception):
+        dts.analyze(models=4, iterations=2, until='forever')
+
+def test_analyze_processes():
+    dts = fresh_population()
+    resultdf = dts.analyze(models=4, iterations=3, processes=2, seed=1)
+    assert 1 == len(resultdf), repr(resultdf)
+    assert 4 == resultdf.ix[3, 0], repr(resultdf)
+    # Recorded as a job, so it can be resumed.
+    generator_id = bayeslite.core.bayesdb_get_generator(
+        dts.bdb, dts.generator_name)
+    assert (3, 0, 1, 1) == bql_utils.analysis_job(dts.bdb, generator_id)[:4]
+
+def test_analyze_seed():
+    thetas = []
+    for entropy in xrange(2):
+        dts = fresh_population()
+        dts.query('INITIALIZE 2 MODELS FOR %g')
+        # The analysis depends on its seed, not on the bdb's prngs.
+        dts.bdb.py_prng.seed(entropy)
+        dts.bdb.np_prng.seed(entropy)
+        dts.analyze(models=0, iterations=2, seed=5)
+        thetas.append(dts.query('''
+            SELECT modelno, theta_json FROM bayesdb_crosscat_theta
+                ORDER BY modelno
+        ''').values.tolist())
+    assert thetas[0] == thetas[1]
+
+def test_append_rows():
+    dts = fresh_population(num_rows=30)
+    dts.analyze(models=2, iterations=2)
+    # Repeat known rows, so there are no unseen categories.
+    delta = dts.df.iloc[:10].copy()
+    assert 10 == dts.append_rows(delta, iterations=1)
+    assert 40 == dts.query('SELECT COUNT(*) FROM %t').iloc[0, 0]
+    assert 40 == len(dts.df)
+    resultdf = dts.analysis_status()
+    assert 2 == resultdf.ix[3, 0], repr(resultdf)
+    dts.query('ESTIMATE PREDICTIVE PROBABILITY OF floats_1 FROM %g')
+    # Crosscat's data covers the new rows, in step with the models.
+    assert 40 == dts.query('''
+        SELECT COUNT(*) FROM bayesdb_crosscat_subsample
+    ''').iloc[0, 0]
+    dts.query('SIMULATE floats_1 FROM %g LIMIT 2')
+    dts.analyze(models=0, iterations=1)
+
+    unseen = delta.iloc[:1].copy()
+    unseen['categorical_1'] = 'Z'
+    with pytest.raises(Exception):
+        dts.append_rows(unseen)
+    assert 40 == dts.query('SELECT COUNT(*) FROM %t').iloc[0, 0]
+
+def test_analyze_resume():
+    dts = fresh_population()
+    with pytest.raises(Exception):
+        dts.analyze(models=0, resume=True)
+    dts.analyze(models=3, iterations=4, checkpoint=2)
+    # Pretend a longer analysis was interrupted after model 0 got partway.
+    bql_utils.start_analysis_job(dts.bdb, dts.generator_name, iterations=6,
+                                 checkpoint=2)
+    dts.query('ANALYZE %g MODELS 0 FOR 2 ITERATIONS WAIT')
+    resultdf = dts.analyze(models=0, resume=True)
+    assert 1 == len(resultdf), repr(resultdf)
+    assert 3 == resultdf.ix[10, 0], repr(resultdf)
+    # Nothing left to do, and resuming adds no models.
+    resultdf = dts.analyze(resume=True)
+    assert 3 == resultdf.ix[10, 0], repr(resultdf)
+    assert 3 == resultdf.sum()[0], repr(resultdf)
+
+def test_analyze_background():
+    tempd = tempfile.mkdtemp(prefix="bdbcontrib-test-population")
+    try:
+        dts = fresh_population(bdb_path=os.path.join(tempd, "data.bdb"))
+        dts.analyze(models=2, iterations=1)
+        job = dts.analyze(models=0, iterations=4, checkpoint=1,
+                          background=True)
+        while not job.wait(0.1):
+            # Readers see whole checkpoints, never a partial analysis.
+            resultdf = dts.analysis_status()
+            assert 1 == len(resultdf), repr(resultdf)
+            dts.query('ESTIMATE PREDICTIVE PROBABILITY OF floats_1 FROM %g')
+        resultdf = dts.analysis_status()
+        assert 2 == resultdf.ix[5, 0], repr(resultdf)
+    finally:
+        import shutil
+        shutil.rmtree(tempd)
+
+def test_snapshot():
+    tempd = tempfile.mkdtemp(prefix="bdbcontrib-test-population")
+    try:
+        dts = fresh_population()
+        dts.analyze(models=2, iterations=2)
+        snapshot = os.path.join(tempd, "snapshot.bdb")
+        dts.export_snapshot(snapshot)
+        served = Population.from_snapshot(
+            snapshot, logger=dts.logger, session_capture_name=False)
+        assert dts.name == served.name
+        assert dts.generator_name == served.generator_name
+        assert dts.table_fingerprint() == served.table_fingerprint()
+        assert 2 == served.analysis_status().ix[2, 0]
+        served.query('ESTIMATE PREDICTIVE PROBABILITY OF floats_1 FROM %g')
+        # Servers cannot change the snapshot they share, but forks can.
+        with pytest.raises(Exception):
+            served.analyze(models=0, iterations=1)
+        assert 2 == served.analysis_status().ix[2, 0]
+        served.fork().analyze(models=0, iterations=1)
+        with pytest.raises(Exception):
+            Population.from_snapshot(os.path.join(tempd, "nonesuch.bdb"))
+    finally:
+        import shutil
+        shutil.rmtree(tempd)
+
+def test_fork():
+    dts = fresh_population()
+    dts.analyze(models=3, iterations=2)
+    forked = dts.fork()
+    assert forked.bdb is not dts.bdb
+    assert forked.df is not dts.df
+    assert forked.generators is not dts.generators
+    forked.analyze(models=0, iterations=1)
+    forked.query('DELETE FROM %t WHERE floats_1 > 0')
+    assert 3 == dts.analysis_status().ix[2, 0]
+    assert 3 == forked.analysis_status().ix[3, 0]
+    assert (dts.query('SELECT COUNT(*) FROM %t').iloc[0, 0] >
+            forked.query('SELECT COUNT(*) FROM %t').iloc[0, 0])
+
+    tempd = tempfile.mkdtemp(prefix="bdbcontrib-test-population")
+    try:
+        path = os.path.join(tempd, "fork.bdb")
+        fewer = dts.fork(path, models=[0, 2])
+        assert path == fewer.bdb_path
+        assert [0, 2] == sorted(fewer.query(
+            'SELECT modelno FROM bayesdb_generator_model')['modelno'])
+        assert 3 == len(dts.query('SELECT modelno FROM bayesdb_generator_model'))
+        fewer.bdb.close()
+    finally:
+        import shutil
+        shutil.rmtree(tempd)
+
+def test_snapshot_path():
+    tempd = tempfile.mkdtemp(prefix="bdbcontrib-test-population")
+    try:
+        snapshot_path = os.path.join(tempd, "durable.bdb")
+        (df, _csv_data) = test_plot_utils.dataset(40)
+        name = ''.join(random.choice(ascii_lowercase) for _ in range(32))
+        def open_population():
+            return Population(name=name, df=df, snapshot_path=snapshot_path,
+                              snapshot_checkpoints=2,
+                              logger=CaptureLogger(
+                                  verbose=pytest.config.option.verbose),
+                              session_capture_name="test_population.py")
+        dts = open_population()
+        assert dts.bdb_path is None
+        dts.analyze(models=2, iterations=4, checkpoint=1)
+        assert os.path.exists(snapshot_path)
+        assert 0 == dts.checkpoints_since_snapshot
+        # A restart restores the analysis from the snapshot.
+        dts.bdb.close()
+        restored = open_population()
+        assert 2 == restored.analysis_status().ix[4, 0]
+        restored.reset()
+        assert 0 == len(restored.analysis_status())
+        with pytest.raises(Exception):
+            Population(name=name, df=df, bdb_path=snapshot_path,
+                       snapshot_path=snapshot_path)
+    finally:
+        import shutil
+        shutil.rmtree(tempd)
+
+def test_analyze_generators():
+    dts = fresh_population()
+    other = dts.name + '_other'
+    dts.query('CREATE GENERATOR %s FOR %%t USING crosscat(GUESS(*))'
+              % (other,))
+    resultdf = dts.analyze(models=2, iterations=2,
+                           generators=[dts.generator_name, other])
+    assert ['generator', 'iterations'] == list(resultdf.index.names)
+    assert 2 == resultdf.ix[(dts.generator_name, 2), 0], repr(resultdf)
+    assert 2 == resultdf.ix[(other, 2), 0], repr(resultdf)
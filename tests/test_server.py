@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2010-2016, MIT Probabilistic Computing Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# matplotlib needs to set the backend before anything else gets to.
+import matplotlib
+matplotlib.use('Agg')
+
+import json
+
+from tornado import gen
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from bdbcontrib import server
+
+from test_population import fresh_population
+
+class TestServer(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.population = fresh_population()
+        self.population.analyze(models=2, iterations=1)
+        # A long window, so that concurrent requests surely share a batch.
+        (app, self.batcher) = server.make_app(self.population, window=0.5)
+        return app
+
+    def tearDown(self):
+        self.batcher.stop()
+        super(TestServer, self).tearDown()
+
+    def query(self, bql, bindings=()):
+        return self.http_client.fetch(
+            self.get_url('/query'), method='POST', raise_error=False,
+            body=json.dumps({'bql': bql, 'bindings': bindings}))
+
+    @gen_test(timeout=30)
+    def test_batched_queries(self):
+        count = 'SELECT COUNT(*) FROM %t WHERE floats_1 > ?'
+        responses = yield [self.query(count, [0]) for _ in range(4)] + [
+            self.query(count, [100]),
+            self.query('ESTIMATE PREDICTIVE PROBABILITY OF floats_1 FROM %g'
+                       ' LIMIT 3'),
+            self.query('SELECT * FROM nonesuch'),
+        ]
+        answers = [json.loads(response.body) for response in responses]
+        assert all(200 == response.code for response in responses[:-1])
+        expected = self.population.query(
+            'SELECT COUNT(*) FROM %t WHERE floats_1 > 0').iloc[0, 0]
+        assert all([[expected]] == answer['rows'] for answer in answers[:4])
+        assert [[0]] == answers[4]['rows']
+        assert 3 == len(answers[5]['rows'])
+        assert 400 == responses[-1].code
+        assert 'error' in answers[-1]
+
+        response = yield self.http_client.fetch(self.get_url('/metrics'))
+        metrics = json.loads(response.body)
+        assert 7 == metrics['requests']
+        assert 1 == metrics['errors']
+        # The four identical queries ran once.
+        assert 4 == metrics['executions']
+        assert metrics['batches'] < 7
+        assert 0 == metrics['queue_depth']
+
+    @gen_test
+    def test_bad_request(self):
+        response = yield self.http_client.fetch(
+            self.get_url('/query'), method='POST', body='not json',
+            raise_error=False)
+        assert 400 == response.code